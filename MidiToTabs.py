@@ -1,15 +1,118 @@
 import sys
 import os
-import mido
-from mido import MidiFile
-from dataclasses import dataclass
-from constraint import *
-import copy
-
-
-@dataclass
+import glob
+import json
+import time
+import io
+import itertools
+import contextlib
+import concurrent.futures
+import mmap
+import struct
+import hashlib
+import tracemalloc
+from array import array
+import argparse
+import importlib.util
+import socket
+import signal
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass, field
+
+
+# Imports a module the first time one of its attributes is used, so commands that never need it start faster
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Only needed to tab, serve or read with mido, listing channels or printing usage doesn't load them
+np = lazy_import("numpy")
+mido = lazy_import("mido")
+asyncio = lazy_import("asyncio")
+deferred_modules = (np, mido, asyncio)
+
+# Costs used by the whole-song fingering search, in units of frets moved by the fretting hand
+HAND_MOVEMENT_COST = 1.0
+STRING_INDEX_COST = 0.25
+HAND_POSITION_COST = 0.25
+FRET_SPAN_COST = 0.1
+UNPLAYABLE_BAR_COST = 20.0
+# Number of lowest cost voicings of each chord the whole-song fingering search chooses between
+GLOBAL_VOICINGS_PER_CHORD = 8
+
+# Which notes of a chord that can't all be played are kept first: the bass and melody notes, the lowest or the highest
+DROP_PRIORITIES = ("bass-melody", "low", "high")
+DROP_PRIORITY = "bass-melody"
+# Most search steps spent finding the largest playable part of one unplayable chord
+FALLBACK_SEARCH_BUDGET = 2000
+
+# Fingering tables built or loaded by this process, keyed by (tuning_offset, capo_offset)
+fingering_tables = {}
+# Start of a saved fingering tables file
+FINGERING_TABLES_MAGIC = b"MTFT"
+
+# Profiler collecting stage timings and counters while one is set with profiling(), None otherwise
+profiler = None
+
+# Measures either side of a changed measure that incremental tabbing solves again
+INCREMENTAL_BOUNDARY_MEASURES = 1
+# Version of the incremental state file, older files are ignored
+INCREMENTAL_STATE_VERSION = 1
+
+# Channel number meaning every channel with notes should be tabbed
+ALL_CHANNELS = "all"
+
+# Low E string tunings and capo frets tried by the tuning/capo sweep
+SWEEP_TUNING_OFFSETS = (0, -1, -2)
+SWEEP_CAPO_OFFSETS = range(0, 8)
+
+# Number of data bytes following the status byte of system messages, for reading raw midi files
+SYSTEM_MESSAGE_DATA_LENGTHS = {0xf1: 1, 0xf2: 2, 0xf3: 1, 0xf6: 0, 0xf8: 0, 0xfa: 0, 0xfb: 0, 0xfc: 0, 0xfe: 0}
+# Longest message the raw midi reader accepts, the same limit mido uses
+MAX_MESSAGE_LENGTH = 1000000
+
+# Names of the notes of an octave, starting from C
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
+# General MIDI instrument of each program number
+INSTRUMENTS = ("Acoustic Grand Piano", "Bright Acoustic Piano", "Electric Grand Piano", "Honky-tonk Piano",
+               "Electric Piano 1", "Electric Piano 2", "Harpsichord", "Clavi", "Celesta", "Glockenspiel",
+               "Music Box", "Vibraphone", "Marimba", "Xylophone", "Tubular Bells", "Dulcimer", "Drawbar Organ",
+               "Percussive Organ", "Rock Organ", "Church Organ", "Reed Organ", "Accordion", "Harmonica",
+               "Tango Accordion", "Acoustic Guitar (nylon)", "Acoustic Guitar (steel)",
+               "Electric Guitar (jazz)", "Electric Guitar (clean)", "Electric Guitar (muted)",
+               "Overdriven Guitar", "Distortion Guitar", "Guitar Harmonics", "Acoustic Bass",
+               "Electric Bass (finger)", "Electric Bass (pick)", "Fretless Bass", "Slap Bass 1", "Slap Bass 2",
+               "Synth Bass 1", "Synth Bass 2", "Violin", "Viola", "Cello", "Contrabass", "Tremolo Strings",
+               "Pizzicato Strings", "Orchestral Harp", "Timpani", "String Ensemble 1", "String Ensemble 2",
+               "Synth Strings 1", "Synth Strings 2", "Choir Aahs", "Voice Oohs", "Synth Voice", "Orchestra Hit",
+               "Trumpet", "Trombone", "Tuba", "Muted Trumpet", "French Horn", "Brass Section", "Synth Brass 1",
+               "Synth Brass 2", "Soprano Sax", "Alto Sax", "Tenor Sax", "Baritone Sax", "Oboe", "English Horn",
+               "Bassoon", "Clarinet", "Piccolo", "Flute", "Recorder", "Pan Flute", "Blown bottle", "Shakuhachi",
+               "Whistle", "Ocarina", "Lead 1 (square)", "Lead 2 (sawtooth)", "Lead 3 (calliope)",
+               "Lead 4 (chiff)", "Lead 5 (charang)", "Lead 6 (voice)", "Lead 7 (fifths)",
+               "Lead 8 (bass + lead)", "Pad 1 (new age)", "Pad 2 (warm)", "Pad 3 (polysynth)", "Pad 4 (choir)",
+               "Pad 5 (bowed)", "Pad 6 (metallic)", "Pad 7 (halo)", "Pad 8 (sweep)", "FX 1 (rain)",
+               "FX 2 (soundtrack)", "FX 3 (crystal)", "FX 4 (atmosphere)", "FX 5 (brightness)",
+               "FX 6 (goblins)", "FX 7 (echoes)", "FX 8 (sci-fi)", "Sitar", "Banjo", "Shamisen", "Koto",
+               "Kalimba", "Bag pipe", "Fiddle", "Shanai", "Tinkle Bell", "Agogô", "Steel Drums", "Woodblock",
+               "Taiko Drum", "Melodic Tom", "Synth Drum", "Reverse Cymbal", "Guitar Fret Noise", "Breath Noise",
+               "Seashore", "Bird Tweet", "Telephone Ring", "Helicopter", "Applause", "Gunshot")
+
+
+# Slotted so a note carries no __dict__, its name is worked out from the note number when asked for
+@dataclass(slots=True)
 class Note:
-    name: str
     note: int
     on: bool
     velocity: int
@@ -17,8 +120,12 @@ class Note:
     time: int
     quarter_beat_index: int
 
+    @property
+    def name(self):
+        return note_number_to_name(self.note)
 
-@dataclass
+
+@dataclass(slots=True)
 class GuitarNote:
     string_name: str
     string_index: int  # number 0-5, 0 representing the high e string
@@ -27,63 +134,329 @@ class GuitarNote:
     quarter_beat_index: int = 0
 
 
+# The chosen guitar notes of a tab kept in compact arrays, GuitarNote objects are only built when asked for
+class GuitarNoteTable:
+    __slots__ = ("string_names", "string_indexes", "frets", "start_times", "quarter_beat_indexes")
+
+    def __init__(self, string_names, guitar_notes=()):
+        self.string_names = string_names
+        self.string_indexes = array("B")
+        self.frets = array("B")
+        self.start_times = array("d")
+        self.quarter_beat_indexes = array("q")
+        for guitar_note in guitar_notes:
+            self.append(guitar_note.string_index, guitar_note.fret, guitar_note.start_time,
+                        guitar_note.quarter_beat_index)
+
+    def append(self, string_index, fret, start_time, quarter_beat_index):
+        self.string_indexes.append(string_index)
+        self.frets.append(fret)
+        self.start_times.append(start_time)
+        self.quarter_beat_indexes.append(quarter_beat_index)
+
+    def __len__(self):
+        return len(self.string_indexes)
+
+    # Slices give a list of GuitarNotes, like slicing the list of them this table replaced
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        string_index = self.string_indexes[index]
+        return GuitarNote(self.string_names[string_index], string_index, self.frets[index], self.start_times[index],
+                          self.quarter_beat_indexes[index])
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+
 @dataclass
 class Tab:
-    guitar_note_list: list
+    guitar_note_list: GuitarNoteTable
+    dropped_notes: list = field(default_factory=list)  # (quarter_beat_index, pitch) left out of unplayable chords
+
+
+# Where a note can be played, string 0-5 (0 representing the high e string) and fret
+Fingering = namedtuple("Fingering", ["string_index", "fret"])
+
+
+# Every string-fret combo of every note playable with one tuning and capo, indexed like a dictionary of notes.
+# The combos of a note are immutable tuples ordered from the high e string down, shared by everything using them
+class FingeringTable:
+    __slots__ = ("tuning_offset", "capo_offset", "low_note", "high_note", "string_names", "positions")
+
+    def __init__(self, tuning_offset, capo_offset, low_note, high_note, string_names, positions):
+        self.tuning_offset = tuning_offset
+        self.capo_offset = capo_offset
+        self.low_note = low_note
+        self.high_note = high_note
+        self.string_names = string_names
+        self.positions = positions
+
+    def __getitem__(self, note):
+        if not self.low_note <= note <= self.high_note:
+            raise KeyError(note)
+        return self.positions[note - self.low_note]
+
+    def __contains__(self, note):
+        return self.low_note <= note <= self.high_note
+
+    def __eq__(self, other):
+        return isinstance(other, FingeringTable) and \
+            (self.tuning_offset, self.capo_offset, self.low_note, self.high_note, self.string_names,
+             self.positions) == (other.tuning_offset, other.capo_offset, other.low_note, other.high_note,
+                                 other.string_names, other.positions)
+
+    # Packs the table as the offsets and note range, the string names, then per note
+    # its number of combos followed by a (string, fret) byte pair for each
+    def to_bytes(self):
+        names = ",".join(self.string_names).encode("ascii")
+        data = bytearray(struct.pack(">bbhhB", self.tuning_offset, self.capo_offset, self.low_note, self.high_note,
+                                     len(names)))
+        data += names
+        for string_fret_combo in self.positions:
+            data.append(len(string_fret_combo))
+            for string_index, fret in string_fret_combo:
+                data += bytes((string_index, fret))
+        return bytes(data)
+
+    # Unpacks a table packed by to_bytes starting at pos, returning it and the position after it
+    @staticmethod
+    def from_bytes(data, pos=0):
+        tuning_offset, capo_offset, low_note, high_note, names_len = struct.unpack_from(">bbhhB", data, pos)
+        pos += struct.calcsize(">bbhhB")
+        string_names = tuple(bytes(data[pos:pos + names_len]).decode("ascii").split(","))
+        pos += names_len
+        positions = []
+        for _ in range(low_note, high_note + 1):
+            num_combos = data[pos]
+            positions.append(tuple(Fingering(data[pos + 1 + 2 * i], data[pos + 2 + 2 * i]) for i in range(num_combos)))
+            pos += 1 + 2 * num_combos
+        return FingeringTable(tuning_offset, capo_offset, low_note, high_note, string_names, tuple(positions)), pos
+
+
+# The note_on events of one channel, kept in compact arrays and iterated as (tick, note, velocity)
+class NoteEvents:
+    __slots__ = ("ticks", "notes", "velocities")
+
+    def __init__(self):
+        self.ticks = array("q")
+        self.notes = array("B")
+        self.velocities = array("B")
+
+    def append(self, tick, note, velocity):
+        self.ticks.append(tick)
+        self.notes.append(note)
+        self.velocities.append(velocity)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __iter__(self):
+        return zip(self.ticks, self.notes, self.velocities)
+
+
+# The notes of one channel as columns sorted by quarter beat index, Note objects are only built when asked for
+class NoteTable:
+    __slots__ = ("ticks", "pitches", "velocities", "seconds", "quarter_beat_indexes", "channel")
+
+    def __init__(self, ticks, pitches, velocities, seconds, quarter_beat_indexes, channel):
+        self.ticks = ticks
+        self.pitches = pitches
+        self.velocities = velocities
+        self.seconds = seconds
+        self.quarter_beat_indexes = quarter_beat_indexes
+        self.channel = channel
+
+    def __len__(self):
+        return len(self.pitches)
+
+    # Slices give a list of Notes, like slicing the list of them this table replaced
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        pitch = int(self.pitches[index])
+        return Note(pitch, True, int(self.velocities[index]), self.channel,
+                    float(self.seconds[index]), int(self.quarter_beat_indexes[index]))
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    # Returns the notes picked by a boolean mask, still sorted
+    def take(self, mask):
+        return NoteTable(self.ticks[mask], self.pitches[mask], self.velocities[mask], self.seconds[mask],
+                         self.quarter_beat_indexes[mask], self.channel)
+
+    # Returns the notes that can be played in the given guitar range, still sorted
+    def in_range(self, guitar_range):
+        return self.take((self.pitches >= guitar_range[0]) & (self.pitches <= guitar_range[1]))
+
+    # Returns the (start, end) index ranges of notes that share a quarter beat
+    def simultaneous_ranges(self):
+        if len(self) == 0:
+            return []
+        boundaries = np.flatnonzero(np.diff(self.quarter_beat_indexes)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(self)]))
+        return zip(starts.tolist(), ends.tolist())
+
+
+# The tempo changes of a whole song as sorted tick breakpoints, each with the seconds elapsed when it is reached,
+# so converting ticks to seconds is a binary search instead of a walk over every tempo change before them
+class TempoMap:
+    __slots__ = ("break_ticks", "break_seconds", "ticks_to_seconds_ratios")
+
+    # Takes (tick, tempo) pairs, the song plays at 120 beats per minute until the first one
+    def __init__(self, tempos, ticks_per_beat):
+        tempos = sorted(tempos, key=lambda x: x[0])
+        self.break_ticks = np.array([0] + [tick for tick, _ in tempos], dtype=np.int64)
+        self.ticks_to_seconds_ratios = np.array([500000 / 1000000 / ticks_per_beat] +
+                                                [tempo / 1000000 / ticks_per_beat for _, tempo in tempos])
+        self.break_seconds = np.concatenate(
+            ([0.0], np.cumsum(np.diff(self.break_ticks) * self.ticks_to_seconds_ratios[:-1])))
+
+    def __eq__(self, other):
+        return isinstance(other, TempoMap) and np.array_equal(self.break_ticks, other.break_ticks) and \
+            np.array_equal(self.ticks_to_seconds_ratios, other.ticks_to_seconds_ratios)
+
+    # Converts an array of ticks to seconds
+    def seconds(self, ticks):
+        segments = np.searchsorted(self.break_ticks, ticks, side="right") - 1
+        return self.break_seconds[segments] + (ticks - self.break_ticks[segments]) * \
+            self.ticks_to_seconds_ratios[segments]
+
 
+@dataclass
+class SongScan:
+    time_info_dict: dict
+    channel_programs: dict  # channel -> last program_change program number
+    channel_notes: dict  # channel -> NoteEvents of its note_on events, ticks counted from track start
+    channel_message_counts: dict  # channel -> number of channel messages
 
-# Returns the channels that have notes, sorted by length of channel
+
+# Raised when the channel asked for has no messages in the song
+class InvalidChannelError(ValueError):
+    def __init__(self, channel_num, valid_channels):
+        super().__init__(f"channel {channel_num} is not valid, valid channels are "
+                         f"{', '.join(str(channel) for channel in valid_channels)}")
+        self.channel_num = channel_num
+        self.valid_channels = valid_channels
+
+
+# The tab of one channel as the Converter returns it
+@dataclass
+class TabResult:
+    channel: int
+    instrument: str
+    tuning_offset: int
+    capo_offset: int
+    time_sig_numerator: int
+    time_sig_denominator: int
+    tab: Tab
+    text: str  # the rendered human-readable tab
+
+
+# Collects the wall time and peak traced memory of each pipeline stage, and counters from the hot paths
+class Profiler:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []  # (name, seconds, peak bytes allocated during the stage or None)
+        self.counters = {}
+        self.distributions = {}  # name -> [count, total, max]
+
+    # Times the with block as a stage, stages must not be nested
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - start_memory if self.trace_memory else None
+            if started_tracing:
+                tracemalloc.stop()
+            self.stages.append((name, elapsed, peak))
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Records one value of something measured many times, like the solutions enumerated per chord
+    def observe(self, name, value):
+        distribution = self.distributions.setdefault(name, [0, 0, 0])
+        distribution[0] += 1
+        distribution[1] += value
+        distribution[2] = max(distribution[2], value)
+
+    def write_text(self, output):
+        output.write("Stage               Seconds   Peak MB\n")
+        for name, seconds, peak in self.stages:
+            peak = f"{peak / 1000000:9.3f}" if peak is not None else f"{'-':>9s}"
+            output.write(f"{name:16s} {seconds:10.4f} {peak}\n")
+        for name, value in self.counters.items():
+            output.write(f"{name}: {value}\n")
+        for name, (count, total, maximum) in self.distributions.items():
+            output.write(f"{name}: count {count} total {total} mean {total / count:.2f} max {maximum}\n")
+
+    # Writes one JSON object per line, for tracking regressions across runs
+    def write_json_lines(self, output):
+        for name, seconds, peak in self.stages:
+            output.write(json.dumps({"stage": name, "seconds": seconds, "peak_bytes": peak}) + "\n")
+        for name, value in self.counters.items():
+            output.write(json.dumps({"counter": name, "value": value}) + "\n")
+        for name, (count, total, maximum) in self.distributions.items():
+            output.write(json.dumps({"distribution": name, "count": count, "total": total, "mean": total / count,
+                                     "max": maximum}) + "\n")
+
+
+# Makes the pipeline report to the given profiler inside the with block, the hook for using it as a library.
+# Given None, whatever profiler is already set stays set
+@contextlib.contextmanager
+def profiling(new_profiler):
+    global profiler
+    if new_profiler is None:
+        yield profiler
+        return
+    # Import the deferred modules now, or the first stage using them would be timed with their imports
+    for module in deferred_modules:
+        getattr(module, "__name__")
+    previous_profiler = profiler
+    profiler = new_profiler
+    try:
+        yield profiler
+    finally:
+        profiler = previous_profiler
+
+
+# Times the with block as a stage of the profiler, if one is set
+def profile_stage(name):
+    return profiler.stage(name) if profiler is not None else contextlib.nullcontext()
+
+
+# Returns the channels that have notes, sorted by length of channel, from a midi file name or its SongScan
 # each returned channel: [instrument_name, channel_legnth, channel_number]
 def get_channel_info(midi_file):
-    instruments = ["Acoustic Grand Piano", "Bright Acoustic Piano", "Electric Grand Piano", "Honky-tonk Piano",
-                   "Electric Piano 1", "Electric Piano 2", "Harpsichord", "Clavi", "Celesta", "Glockenspiel",
-                   "Music Box", "Vibraphone", "Marimba", "Xylophone", "Tubular Bells", "Dulcimer", "Drawbar Organ",
-                   "Percussive Organ", "Rock Organ", "Church Organ", "Reed Organ", "Accordion", "Harmonica",
-                   "Tango Accordion", "Acoustic Guitar (nylon)", "Acoustic Guitar (steel)",
-                   "Electric Guitar (jazz)", "Electric Guitar (clean)", "Electric Guitar (muted)",
-                   "Overdriven Guitar", "Distortion Guitar", "Guitar Harmonics", "Acoustic Bass",
-                   "Electric Bass (finger)", "Electric Bass (pick)", "Fretless Bass", "Slap Bass 1", "Slap Bass 2",
-                   "Synth Bass 1", "Synth Bass 2", "Violin", "Viola", "Cello", "Contrabass", "Tremolo Strings",
-                   "Pizzicato Strings", "Orchestral Harp", "Timpani", "String Ensemble 1", "String Ensemble 2",
-                   "Synth Strings 1", "Synth Strings 2", "Choir Aahs", "Voice Oohs", "Synth Voice", "Orchestra Hit",
-                   "Trumpet", "Trombone", "Tuba", "Muted Trumpet", "French Horn", "Brass Section", "Synth Brass 1",
-                   "Synth Brass 2", "Soprano Sax", "Alto Sax", "Tenor Sax", "Baritone Sax", "Oboe", "English Horn",
-                   "Bassoon", "Clarinet", "Piccolo", "Flute", "Recorder", "Pan Flute", "Blown bottle", "Shakuhachi",
-                   "Whistle", "Ocarina", "Lead 1 (square)", "Lead 2 (sawtooth)", "Lead 3 (calliope)",
-                   "Lead 4 (chiff)", "Lead 5 (charang)", "Lead 6 (voice)", "Lead 7 (fifths)",
-                   "Lead 8 (bass + lead)", "Pad 1 (new age)", "Pad 2 (warm)", "Pad 3 (polysynth)", "Pad 4 (choir)",
-                   "Pad 5 (bowed)", "Pad 6 (metallic)", "Pad 7 (halo)", "Pad 8 (sweep)", "FX 1 (rain)",
-                   "FX 2 (soundtrack)", "FX 3 (crystal)", "FX 4 (atmosphere)", "FX 5 (brightness)",
-                   "FX 6 (goblins)", "FX 7 (echoes)", "FX 8 (sci-fi)", "Sitar", "Banjo", "Shamisen", "Koto",
-                   "Kalimba", "Bag pipe", "Fiddle", "Shanai", "Tinkle Bell", "Agogô", "Steel Drums", "Woodblock",
-                   "Taiko Drum", "Melodic Tom", "Synth Drum", "Reverse Cymbal", "Guitar Fret Noise", "Breath Noise",
-                   "Seashore", "Bird Tweet", "Telephone Ring", "Helicopter", "Applause", "Gunshot"]
-    channels_dict = {}
-    channels_instr = {}
-    song = MidiFile(midi_file, clip=True)
-
-    for track_index in range(len(song.tracks)):
-        total_time = 0
-        for message in song.tracks[track_index]:
-            total_time += message.time
-            if type(message) == mido.messages.messages.Message and message.type == "program_change":
-                channels_instr[message.channel] = instruments[message.program]
-            if type(message) == mido.messages.messages.Message and message.type == 'note_on':
-                channels_dict.setdefault(message.channel, [])
-                channels_dict[message.channel].append(message)
+    song_scan = midi_file if isinstance(midi_file, SongScan) else read_song(midi_file)
 
     non_empty_channels = []
-    for channel in channels_dict:
+    for channel, note_events in song_scan.channel_notes.items():
         if channel == 9:
             continue
-        non_empty_channels.append((channels_instr[channel], len(channels_dict[channel]), channel))
+        # Channels that never pick an instrument play the General MIDI default, program 0
+        instrument = INSTRUMENTS[song_scan.channel_programs.get(channel, 0)]
+        non_empty_channels.append((instrument, len(note_events), channel))
 
     returned_channels = sorted(non_empty_channels, key=lambda x: x[1], reverse=True)
     return returned_channels
 
 
-# Given tuning and capo offsets, create a dictionary of notes to fret-string combos
-def create_guitar_index(tuning_offset, capo_offset):
+# Builds the fingering table of a tuning and capo, listing every string-fret combo of every playable note
+def build_fingering_table(tuning_offset, capo_offset):
     e_string = (64 + capo_offset, 83)
     b_string = (59 + capo_offset, 78)
     g_string = (55 + capo_offset, 74)
@@ -91,64 +464,238 @@ def create_guitar_index(tuning_offset, capo_offset):
     a_string = (45 + capo_offset, 64)
     low_e_string = (40 + capo_offset + tuning_offset, 57 + tuning_offset)
 
-    note_names = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    low_e_string_name = note_names[((40 + tuning_offset) % 12)]
+    low_e_string_name = NOTE_NAMES[((40 + tuning_offset) % 12)]
 
-    guitar_index = {}
+    positions = []
     for note_num in range(low_e_string[0], e_string[1] + 1):
         string_fret_combo = []
-        if e_string[0] <= note_num <= e_string[1]:
-            string_fret_combo.append(GuitarNote("e", 0, note_num - e_string[0]))
-        if b_string[0] <= note_num <= b_string[1]:
-            string_fret_combo.append(GuitarNote("B", 1, note_num - b_string[0]))
-        if g_string[0] <= note_num <= g_string[1]:
-            string_fret_combo.append(GuitarNote("G", 2, note_num - g_string[0]))
-        if d_string[0] <= note_num <= d_string[1]:
-            string_fret_combo.append(GuitarNote("D", 3, note_num - d_string[0]))
-        if a_string[0] <= note_num <= a_string[1]:
-            string_fret_combo.append(GuitarNote("A", 4, note_num - a_string[0]))
-        if low_e_string[0] <= note_num <= low_e_string[1]:
-            string_fret_combo.append(GuitarNote(low_e_string_name, 5, note_num - low_e_string[0]))
-
-        guitar_index[note_num] = string_fret_combo
-
-    return guitar_index, (low_e_string[0], e_string[1])
-
-
-# Captures important info from midi song
-def create_time_info_dict(midi_song):
-    # Figure out the midi tick to seconds ratio
+        for string_index, guitar_string in enumerate((e_string, b_string, g_string, d_string, a_string, low_e_string)):
+            if guitar_string[0] <= note_num <= guitar_string[1]:
+                string_fret_combo.append(Fingering(string_index, note_num - guitar_string[0]))
+        positions.append(tuple(string_fret_combo))
+
+    return FingeringTable(tuning_offset, capo_offset, low_e_string[0], e_string[1],
+                          ("e", "B", "G", "D", "A", low_e_string_name), tuple(positions))
+
+
+# Given tuning and capo offsets, returns the fingering table of notes to fret-string combos and the range
+# of playable notes. Tables are only built once per process
+def create_guitar_index(tuning_offset, capo_offset):
+    if (tuning_offset, capo_offset) not in fingering_tables:
+        fingering_tables[(tuning_offset, capo_offset)] = build_fingering_table(tuning_offset, capo_offset)
+    guitar_index = fingering_tables[(tuning_offset, capo_offset)]
+    return guitar_index, (guitar_index.low_note, guitar_index.high_note)
+
+
+# Loads saved fingering tables so this process doesn't build them again
+def load_fingering_tables(tables_file):
+    with open(tables_file, "rb") as f:
+        data = f.read()
+    if data[:4] != FINGERING_TABLES_MAGIC:
+        raise OSError(f"{tables_file} is not a fingering tables file")
+    (num_tables,) = struct.unpack_from(">H", data, 4)
+    pos = 6
+    for _ in range(num_tables):
+        guitar_index, pos = FingeringTable.from_bytes(data, pos)
+        fingering_tables[(guitar_index.tuning_offset, guitar_index.capo_offset)] = guitar_index
+
+
+# Saves every fingering table this process has built or loaded
+def save_fingering_tables(tables_file):
+    data = bytearray(FINGERING_TABLES_MAGIC)
+    data += struct.pack(">H", len(fingering_tables))
+    for guitar_index in fingering_tables.values():
+        data += guitar_index.to_bytes()
+    temp_file = f"{tables_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(data)
+    os.replace(temp_file, tables_file)
+
+
+# Captures important info from midi song, given the tempo changes found in all its tracks
+# and the first time signature found in its first track
+def create_time_info_dict(ticks_per_beat, tempos, time_signature):
+    # Quarter beats are counted from ticks and times come from the tempo map
     time_info_dict = {}
-    tempo = 500000
-    time_sig_numerator = 4
-    time_sig_denominator = 4
-    found_tempo = False
-    found_numerator = False
-    for message in midi_song.tracks[0]:
-        if type(message) == mido.midifiles.meta.MetaMessage:
-            if message.type == 'set_tempo':
-                tempo = message.tempo
-                found_tempo = True
-                if found_tempo and found_numerator:
-                    break
-            if message.type == 'time_signature':
-                time_sig_numerator = message.numerator
-                time_sig_denominator = message.denominator
-                found_numerator = True
-                if found_tempo and found_numerator:
-                    break
-    ticks_to_seconds_ratio = tempo / 1000000 / midi_song.ticks_per_beat
-    seconds_per_beat = midi_song.ticks_per_beat * ticks_to_seconds_ratio
-    time_info_dict["tempos"] = []
-    time_info_dict["ticks_per_beat"] = midi_song.ticks_per_beat
+    time_sig_numerator, time_sig_denominator = time_signature if time_signature else (4, 4)
+    time_info_dict["tempo_map"] = TempoMap(tempos, ticks_per_beat)
+    time_info_dict["ticks_per_beat"] = ticks_per_beat
     time_info_dict["time_sig_numerator"] = time_sig_numerator
     time_info_dict["time_sig_denominator"] = time_sig_denominator
-    time_info_dict["ticks_to_seconds_ratio"] = ticks_to_seconds_ratio
-    time_info_dict["seconds_per_beat"] = seconds_per_beat
 
     return time_info_dict
 
 
+# Reads everything the translation needs from a midi song in a single pass over its messages
+def scan_song(song):
+    channel_programs = {}
+    channel_notes = {}
+    channel_message_counts = {}
+    tempos = []
+    time_signature = None
+    for track_index in range(len(song.tracks)):
+        total_time = 0
+        for message in song.tracks[track_index]:
+            total_time += message.time
+
+            # tempo changes can be in any track, the time signature of the whole song is expected in the first track
+            if message.is_meta:
+                if message.type == 'set_tempo':
+                    tempos.append((total_time, message.tempo))
+                elif message.type == 'time_signature' and time_signature is None and track_index == 0:
+                    time_signature = (message.numerator, message.denominator)
+                continue
+
+            channel = getattr(message, "channel", None)
+            if channel is None:
+                continue
+            channel_message_counts[channel] = channel_message_counts.get(channel, 0) + 1
+            if message.type == 'program_change':
+                channel_programs[channel] = message.program
+            elif message.type == 'note_on':
+                channel_notes.setdefault(channel, NoteEvents()).append(total_time, message.note, message.velocity)
+
+    return SongScan(create_time_info_dict(song.ticks_per_beat, tempos, time_signature),
+                    channel_programs, channel_notes, channel_message_counts)
+
+
+# Scans the bytes of a standard midi file the same way scan_song scans what mido parses from them, decoding only
+# the messages the translation needs instead of building a mido message for every event
+def scan_song_bytes(data, channels_only=False):
+    if len(data) < 8:
+        raise EOFError
+    name, size = struct.unpack_from(">4sL", data, 0)
+    if name != b"MThd":
+        raise OSError("MThd not found. Probably not a MIDI file")
+    if len(data) < 8 + size or size < 6:
+        raise EOFError
+    _, num_tracks, ticks_per_beat = struct.unpack_from(">hhh", data, 8)
+    pos = 8 + size
+
+    channel_programs = {}
+    channel_notes = {}
+    channel_message_counts = {}
+    tempos = []
+    time_signature = None
+    # Reading past the end of the data raises IndexError, which means the file was cut short
+    try:
+        for track_index in range(num_tracks):
+            if pos + 8 > len(data):
+                raise EOFError
+            name, size = struct.unpack_from(">4sL", data, pos)
+            if name != b"MTrk":
+                raise OSError("no MTrk header at start of track")
+            pos += 8
+            track_end = pos + size
+            total_time = 0
+            last_status = None
+            while pos != track_end:
+                # Delta time as a variable length quantity
+                byte = data[pos]
+                pos += 1
+                delta = byte & 0x7f
+                while byte >= 0x80:
+                    byte = data[pos]
+                    pos += 1
+                    delta = (delta << 7) | (byte & 0x7f)
+                total_time += delta
+
+                status = data[pos]
+                if status < 0x80:
+                    if last_status is None:
+                        raise OSError("running status without last_status")
+                    status = last_status
+                else:
+                    pos += 1
+                    if status != 0xff:
+                        # Meta messages don't set running status
+                        last_status = status
+
+                if status < 0xf0:
+                    # Channel message, data bytes above 127 are clipped like mido's clip=True
+                    message_type = status & 0xf0
+                    channel = status & 0x0f
+                    channel_message_counts[channel] = channel_message_counts.get(channel, 0) + 1
+                    if message_type == 0x90:
+                        note = data[pos]
+                        velocity = data[pos + 1]
+                        note_events = channel_notes.get(channel)
+                        if note_events is None:
+                            note_events = channel_notes[channel] = NoteEvents()
+                        note_events.ticks.append(total_time)
+                        note_events.notes.append(note if note < 127 else 127)
+                        note_events.velocities.append(velocity if velocity < 127 else 127)
+                        pos += 2
+                    elif message_type == 0xc0 or message_type == 0xd0:
+                        if message_type == 0xc0:
+                            program = data[pos]
+                            channel_programs[channel] = program if program < 127 else 127
+                        pos += 1
+                    else:
+                        pos += 2
+                    continue
+
+                if status == 0xff or status == 0xf0 or status == 0xf7:
+                    if status == 0xff:
+                        meta_type = data[pos]
+                        pos += 1
+                    length = 0
+                    while True:
+                        byte = data[pos]
+                        pos += 1
+                        length = (length << 7) | (byte & 0x7f)
+                        if byte < 0x80:
+                            break
+                    if length > MAX_MESSAGE_LENGTH:
+                        raise OSError(f"Message length {length} exceeds maximum length {MAX_MESSAGE_LENGTH}")
+                    if pos + length > len(data):
+                        raise EOFError
+                    if status == 0xff:
+                        if meta_type == 0x51:
+                            tempos.append((total_time, (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]))
+                        elif meta_type == 0x58 and time_signature is None and track_index == 0:
+                            time_signature = (data[pos], 2 ** data[pos + 1])
+                    pos += length
+                    continue
+
+                if status not in SYSTEM_MESSAGE_DATA_LENGTHS:
+                    raise OSError(f"undefined status byte 0x{status:02x}")
+                pos += SYSTEM_MESSAGE_DATA_LENGTHS[status]
+                if pos > len(data):
+                    raise EOFError
+    except IndexError:
+        raise EOFError
+
+    if channels_only:
+        # Only the number of note events of each channel is wanted, timing info would need numpy
+        return SongScan(None, channel_programs, channel_notes, channel_message_counts)
+
+    return SongScan(create_time_info_dict(ticks_per_beat, tempos, time_signature),
+                    channel_programs, channel_notes, channel_message_counts)
+
+
+# Reads in the midi file and scans it, either with mido or by memory mapping the file and scanning its bytes.
+# With channels_only the bytes are always scanned, only for the programs and note events of each channel
+def read_song(midi_file, raw_reader=False, channels_only=False):
+    if not raw_reader and not channels_only:
+        return scan_song(mido.MidiFile(midi_file, clip=True))
+
+    with open(midi_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise EOFError
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return scan_song_bytes(data, channels_only)
+
+
+# Scans the bytes of a midi file already in memory, either with mido or the byte scanner
+def read_song_bytes(data, raw_reader=False):
+    if not raw_reader:
+        return scan_song(mido.MidiFile(file=io.BytesIO(data), clip=True))
+    if len(data) == 0:
+        raise EOFError
+    return scan_song_bytes(data)
+
+
 # Clears the given directory from path of all files
 def clear_directory(path):
     for filename in os.listdir(path):
@@ -157,325 +704,1285 @@ def clear_directory(path):
             os.remove(file_path)
 
 
-# Splits a given midi song into midi files containing each
-# track separately, saves them in the given destination
-def song_to_tracks(song: MidiFile, channel_num):
-    # Splitting Tracks and Writing Files to destination_dir
-    important_meta_messages = []
-    channels_dict = {}
-    for track_index in range(len(song.tracks)):
-        total_time = 0
-        for message in song.tracks[track_index]:
-            total_time += message.time
-
-            # hard coding place to find important meta messages,
-            # add specific meta messages to all tracks so that they play the correct tempo/key/etc.
-            if track_index == 0 and type(message) == mido.midifiles.meta.MetaMessage:
-                if message.type == 'key_signature' or \
-                        message.type == 'time_signature' or \
-                        message.type == 'smpte_offset' or \
-                        message.type == 'set_tempo':
-                    important_meta_messages.append(message)
-            elif type(message) == mido.messages.messages.Message and message.type != 'sysex':
-                try:
-                    channels_dict.setdefault(message.channel, (important_meta_messages.copy(), 0))
-                    message.time = total_time - channels_dict[message.channel][1]
-                    channels_dict[message.channel][0].append(message)
-                    channels_dict[message.channel] = (channels_dict[message.channel][0], total_time)
-                except Exception as e:
-                    print(message)
-                    print(e)
-
+# Picks the channel to translate, -1 choosing the channel with the most messages
+def select_channel(song_scan, channel_num):
+    channels_dict = song_scan.channel_message_counts.copy()
     if channel_num == -1:
         if 9 in channels_dict:
             channels_dict.pop(9)
-        channel_num = max(channels_dict, key=lambda channel_index: len(channels_dict[channel_index][0]))
-
-    # clear_directory("SplitTrackDepot")
-    # for channel in channels_dict:
-    #     temp_song = MidiFile()
-    #     temp_song.tracks.append(important_meta_messages + channels_dict[channel][0])
-    #     temp_song.ticks_per_beat = 480
-    #     temp_song.save(f'SplitTrackDepot\\{channel}.mid')
+        channel_num = max(channels_dict, key=lambda channel_index: channels_dict[channel_index])
 
     if channel_num in channels_dict:
-        return important_meta_messages + channels_dict[channel_num][0]
-    else:
-        print("Invalid channel selected. Here is a list of valid channels:")
-        for key in channels_dict:
-            print(key)
-        exit()
+        return channel_num
+    raise InvalidChannelError(channel_num, list(channels_dict))
 
 
 # Translates from MIDI note number (0-128) to name with octave and number
 def note_number_to_name(note_number):
-    # Define a list of note names
-    note_names = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
     # Calculate the octave and note index
     octave = note_number // 12
     note_index = note_number % 12
     # Get the note name based on the note index
-    note_name = note_names[note_index]
+    note_name = NOTE_NAMES[note_index]
     return f"{note_name}{octave}"
 
 
-# Create notes from the given track
-def create_notes(single_track, time_info_dict, guitar_range):
-    notes_on = []
-    time_counter = 0
-    time_seconds = 0
-    for message in single_track:
-        try:
-            if type(message) == mido.midifiles.meta.MetaMessage and message.type == "set_tempo":
-                pass
-            else:
-                time_counter += message.time
-
-            if len(time_info_dict["tempos"]) > 0 and time_counter >= time_info_dict["tempos"][0][1]:
-                new_tempo = time_info_dict["tempos"].pop()[0]
-                time_info_dict["ticks_to_seconds_ratio"] = \
-                    new_tempo / 1000000 / time_info_dict["ticks_per_beat"]
-                time_info_dict["seconds_per_beat"] = \
-                    time_info_dict["ticks_per_beat"] * time_info_dict["ticks_to_seconds_ratio"]
-            # Calculate the correct time in seconds by doing MIDI Ticks * (Tempo / PPQ)
-            # In this case, we have tempo in microseconds, so we divide by 1000000
-            # to get tempo in seconds. 480 PPQ is found in the header of the MidiFile
-            # "ticks_per_beat" and tempo is found in a MetaMessage in the track
-            # named 'set_tempo' as the value tempo
-            time_seconds = time_counter * time_info_dict["ticks_to_seconds_ratio"]
-        except Exception as e:
-            print("Message without time:" + str(message) + str(e))
-        if type(message) == mido.midifiles.meta.MetaMessage:
-            if message.type == "set_tempo":
-                time_info_dict["tempos"].append((message.tempo, message.time))
-            continue
-        if message.type == "note_on":
-            note_in_range = guitar_range[0] <= message.note <= guitar_range[1]
-            if note_in_range is False:
+# Rounds ticks to the nearest quarter beat (a sixteenth note), counting from 1, ties going to the even quarter beat
+def ticks_to_quarter_beat_indexes(ticks, ticks_per_beat):
+    quarter_beats, remainder = np.divmod(4 * ticks, ticks_per_beat)
+    round_up = (2 * remainder > ticks_per_beat) | ((2 * remainder == ticks_per_beat) & (quarter_beats % 2 == 1))
+    return 1 + quarter_beats + round_up
+
+
+# Create the note table of a channel from its (tick, note, velocity) events
+def create_notes(note_events, time_info_dict, guitar_range, channel=0):
+    ticks = np.frombuffer(note_events.ticks, dtype=np.int64)
+    pitches = np.frombuffer(note_events.notes, dtype=np.uint8)
+    velocities = np.frombuffer(note_events.velocities, dtype=np.uint8)
+
+    note_in_range = (pitches >= guitar_range[0]) & (pitches <= guitar_range[1])
+    if profiler is not None:
+        profiler.count("notes_out_of_range", len(pitches) - int(np.count_nonzero(note_in_range)))
+    ticks = ticks[note_in_range]
+    pitches = pitches[note_in_range]
+    velocities = velocities[note_in_range]
+
+    quarter_beat_indexes = ticks_to_quarter_beat_indexes(ticks, time_info_dict["ticks_per_beat"])
+    order = np.argsort(quarter_beat_indexes, kind="stable")
+    ticks = ticks[order]
+    return NoteTable(ticks, pitches[order], velocities[order], time_info_dict["tempo_map"].seconds(ticks),
+                     quarter_beat_indexes[order], channel)
+
+
+# Checks if two fingerings can be fretted at the same time, allowing a wider reach when one is an open string
+def frets_compatible(a, b):
+    fret_distance = abs(a.fret - b.fret)
+    return fret_distance <= 4 or ((a.fret == 0 or b.fret == 0) and fret_distance <= 7)
+
+
+# Checks if the fretted notes of a voicing can be held, needing a bar when more than 4 frets are pressed
+def is_playable_bar(frets):
+    fret_nums = [fret for fret in frets if fret != 0]
+    if len(fret_nums) <= 4:
+        return True
+    necessary_bar_len = 2 if len(fret_nums) == 5 else 3
+    for x in range(1, 15):
+        if fret_nums.count(x) >= necessary_bar_len:
+            return True
+        elif fret_nums.count(x) == 1:
+            return False
+    return False
+
+
+# Searches for the lowest cost voicings of the given candidate fingerings, one list of candidates per note.
+# Voicings that need an unplayable bar always cost more than playable ones, after that the lowest sum of
+# string indexes wins, then the smallest fret span. Returns up to limit (cost, voicing) pairs, best first,
+# each voicing holding the chosen fingering per note. The number of complete voicings the search reached is
+# appended to solution_counts, if given
+def find_voicings(candidate_lists, limit=1, solution_counts=None):
+    # Fill the most constrained notes first so dead ends are found early
+    order = sorted(range(len(candidate_lists)), key=lambda index: len(candidate_lists[index]))
+    ordered_candidates = [sorted(candidate_lists[index], key=lambda x: x.string_index) for index in order]
+
+    # Lowest string index sum still reachable from each depth, used to prune branches that can't win
+    min_remaining_cost = [0] * (len(ordered_candidates) + 1)
+    for depth in range(len(ordered_candidates) - 1, -1, -1):
+        min_remaining_cost[depth] = min_remaining_cost[depth + 1] + ordered_candidates[depth][0].string_index
+
+    chosen = [None] * len(ordered_candidates)
+    # The best voicings found so far, kept sorted so the last one is the one to beat once there are enough
+    best = []
+    # Complete voicings reached by the search
+    enumerated = [0]
+
+    def search(depth, string_sum, used_strings):
+        if len(best) == limit and (0, string_sum + min_remaining_cost[depth], 0) >= best[-1][0]:
+            return
+        if depth == len(ordered_candidates):
+            enumerated[0] += 1
+            frets = [guitar_note.fret for guitar_note in chosen]
+            cost = (0 if is_playable_bar(frets) else 1, string_sum, max(frets) - min(frets))
+            if len(best) < limit or cost < best[-1][0]:
+                insert_index = len(best)
+                while insert_index > 0 and cost < best[insert_index - 1][0]:
+                    insert_index -= 1
+                best.insert(insert_index, (cost, chosen.copy()))
+                del best[limit:]
+            return
+        for candidate in ordered_candidates[depth]:
+            if used_strings & (1 << candidate.string_index):
+                continue
+            if not all(frets_compatible(candidate, chosen[i]) for i in range(depth)):
                 continue
-            temp_note = Note(note_number_to_name(message.note), message.note,
-                             True, message.velocity, message.channel, time_seconds,
-                             1 + round(4*time_seconds/time_info_dict["seconds_per_beat"]))
-            notes_on.append(temp_note)
+            chosen[depth] = candidate
+            search(depth + 1, string_sum + candidate.string_index, used_strings | (1 << candidate.string_index))
+        chosen[depth] = None
+
+    search(0, 0, 0)
+    if solution_counts is not None:
+        solution_counts.append(enumerated[0])
+
+    voicings = []
+    for cost, ordered_voicing in best:
+        voicing = [None] * len(candidate_lists)
+        for depth, index in enumerate(order):
+            voicing[index] = ordered_voicing[depth]
+        voicings.append((cost, voicing))
+    return voicings
+
+
+# Searches for the lowest cost voicing of the given candidate fingerings, one list of candidates per note.
+# Returns the chosen fingering per note, or None if no voicing exists
+def find_best_voicing(candidate_lists, solution_counts=None):
+    voicings = find_voicings(candidate_lists, solution_counts=solution_counts)
+    return voicings[0][1] if voicings else None
+
+
+# Orders the sorted pitches of a chord from the most to the least important to keep
+def prioritize_pitches(pitches, drop_priority=DROP_PRIORITY):
+    if drop_priority == "low":
+        return list(pitches)
+    if drop_priority == "high":
+        return list(reversed(pitches))
+    if drop_priority == "bass-melody":
+        # The bass note, then the melody note and the inner notes from the top down
+        return [pitches[0]] + list(reversed(pitches[1:]))
+    raise ValueError(f"unknown drop priority {drop_priority}, expected one of {', '.join(DROP_PRIORITIES)}")
+
+
+# Finds the largest set of the given sorted pitches that can be fingered at once, keeping the more important
+# notes by drop_priority when sets are the same size. Every note is either kept on one of its fingerings or
+# dropped in a single depth-first search, taking at most budget steps so the time per chord is bounded.
+# When the budget runs out the best set found so far is returned, the first one found is the greedy choice of
+# keeping each note by priority if it fits. Returns the kept pitches, sorted
+def find_playable_subset(pitches, guitar_index, drop_priority=DROP_PRIORITY, budget=FALLBACK_SEARCH_BUDGET):
+    ordered_pitches = prioritize_pitches(pitches, drop_priority)
+    candidate_lists = [guitar_index[pitch] for pitch in ordered_pitches]
+    num_pitches = len(ordered_pitches)
+
+    chosen = []
+    # (number kept, kept bits with the most important note highest)
+    best = [(0, 0)]
+    steps = [0]
+
+    def search(index, used_strings, kept_bits):
+        steps[0] += 1
+        if index == num_pitches:
+            if (len(chosen), kept_bits) > best[0]:
+                best[0] = (len(chosen), kept_bits)
+            return
+        # Each kept note takes a string, so no more than six can be kept
+        most_kept = len(chosen) + min(num_pitches - index, 6 - len(chosen))
+        remaining_bits = (1 << (num_pitches - index)) - 1
+        if (most_kept, kept_bits | remaining_bits) <= best[0] or steps[0] > budget:
+            return
+        bit = 1 << (num_pitches - 1 - index)
+        for candidate in candidate_lists[index]:
+            if used_strings & (1 << candidate.string_index):
+                continue
+            if not all(frets_compatible(candidate, fingering) for fingering in chosen):
+                continue
+            chosen.append(candidate)
+            search(index + 1, used_strings | (1 << candidate.string_index), kept_bits | bit)
+            chosen.pop()
+        search(index + 1, used_strings, kept_bits)
+
+    search(0, 0, 0)
+    if profiler is not None:
+        profiler.observe("fallback_search_steps", steps[0])
+
+    kept_bits = best[0][1]
+    return tuple(sorted(pitch for index, pitch in enumerate(ordered_pitches)
+                        if kept_bits & (1 << (num_pitches - 1 - index))))
+
+
+# Remembers the voicings found for pitch sets under one tuning and capo, evicting the least recently used.
+# An unplayable pitch set keeps, per drop priority, the largest playable part found for it and that part's voicing.
+# Entries can be saved to and loaded from a json cache file, which may hold voicings for many tunings and capos
+class VoicingCache:
+    def __init__(self, tuning_offset, capo_offset, max_size=4096, cache_file=None):
+        self.tuning_offset = tuning_offset
+        self.capo_offset = capo_offset
+        self.max_size = max_size
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self.voicings = OrderedDict()
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.load(cache_file)
+
+    # Returns (found, voicing), the voicing being a tuple of (string_index, fret) per pitch or None if unplayable
+    def get(self, pitches):
+        key = (self.tuning_offset, self.capo_offset, pitches)
+        if key in self.voicings:
+            self.hits += 1
+            self.voicings.move_to_end(key)
+            # Unplayable pitch sets hold a dict of their playable parts instead of a voicing
+            voicing = self.voicings[key]
+            return True, voicing if not isinstance(voicing, dict) else None
+        self.misses += 1
+        return False, None
+
+    def put(self, pitches, voicing):
+        self.store((self.tuning_offset, self.capo_offset, pitches), voicing if voicing is not None else {})
+
+    # Returns (kept_pitches, voicing) of the playable part of an unplayable pitch set kept with the drop priority,
+    # or None if it hasn't been searched for
+    def get_subset(self, pitches, drop_priority):
+        subsets = self.voicings.get((self.tuning_offset, self.capo_offset, pitches))
+        return subsets.get(drop_priority) if isinstance(subsets, dict) else None
+
+    def put_subset(self, pitches, drop_priority, kept_pitches, voicing):
+        key = (self.tuning_offset, self.capo_offset, pitches)
+        subsets = self.voicings.get(key)
+        subsets = dict(subsets) if isinstance(subsets, dict) else {}
+        subsets[drop_priority] = (kept_pitches, voicing)
+        self.store(key, subsets)
+
+    def store(self, key, value):
+        self.voicings[key] = value
+        self.voicings.move_to_end(key)
+        while len(self.voicings) > self.max_size:
+            self.voicings.popitem(last=False)
+
+    def load(self, cache_file):
+        with open(cache_file) as f:
+            entries = json.load(f)
+        for tuning_offset, capo_offset, pitches, voicing in entries[-self.max_size:]:
+            if voicing is None:
+                # Saved before playable parts were kept
+                voicing = {}
+            elif isinstance(voicing, dict):
+                voicing = {drop_priority: (tuple(kept_pitches), tuple(tuple(position) for position in kept_voicing))
+                           for drop_priority, (kept_pitches, kept_voicing) in voicing.items()}
+            else:
+                voicing = tuple(tuple(position) for position in voicing)
+            self.voicings[(tuning_offset, capo_offset, tuple(pitches))] = voicing
+
+    def save(self, cache_file=None):
+        cache_file = cache_file if cache_file is not None else self.cache_file
+        entries = [[tuning_offset, capo_offset, list(pitches), voicing]
+                   for (tuning_offset, capo_offset, pitches), voicing in self.voicings.items()]
+        # Write next to the destination then swap it in, so parallel runs never read a half written file
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(entries, f)
+        os.replace(temp_file, cache_file)
+
+
+# Finds the voicing of the given sorted pitches as (string_index, fret) per pitch, or None if it is unplayable
+def find_pitch_voicing(pitches, guitar_index, voicing_cache=None, solution_counts=None):
+    if voicing_cache is not None:
+        found, voicing = voicing_cache.get(pitches)
+        if found:
+            if profiler is not None:
+                profiler.count("voicing_cache_hits")
+            return voicing
+
+    voicing = find_best_voicing([guitar_index[pitch] for pitch in pitches], solution_counts)
+    if voicing is not None:
+        voicing = tuple((guitar_note.string_index, guitar_note.fret) for guitar_note in voicing)
+
+    if voicing_cache is not None:
+        voicing_cache.put(pitches, voicing)
+    return voicing
+
+
+# Counts a chord of more than one note whose voicing had to be searched for, with the solutions enumerated by
+# the searches it took. Single notes and chords found in a cache aren't counted, in either fingering mode
+def count_chord_solved(simultaneous_pitches, solution_counts):
+    if profiler is not None and solution_counts and len(simultaneous_pitches) > 1:
+        profiler.count("chords_solved")
+        profiler.observe("solutions_per_chord", sum(solution_counts))
+
+
+# Given the pitches of notes to be played simultaneously, chooses the best fingering for them to be played.
+# When they can't all be played, the largest playable set is kept and the (quarter_beat_index, pitch) of
+# each note left out is added to dropped_notes, if given
+def optimize_simultaneous_pitches(simultaneous_pitches, quarter_beat_index, guitar_index, voicing_cache=None,
+                                  drop_priority=DROP_PRIORITY, dropped_notes=None):
+    pitches = tuple(sorted(set(simultaneous_pitches)))
+    # Solutions enumerated by each search this chord needed, for the profiler
+    solution_counts = [] if profiler is not None else None
+
+    voicing = find_pitch_voicing(pitches, guitar_index, voicing_cache, solution_counts)
+    if voicing is None:
+        # The playable part of a repeated unplayable chord is only searched for once
+        subset = voicing_cache.get_subset(pitches, drop_priority) if voicing_cache is not None else None
+        if subset is not None:
+            kept_pitches, kept_voicing = subset
         else:
-            pass  # print("Not a Note!")
-
-    notes_on = sorted(notes_on, key=lambda x: x.quarter_beat_index)
-    return notes_on
-
-
-# Pick the solution with the lowest avg string value
-def pick_min_string_index(solutions):
-    min_solution = solutions[0]
-
-    min_avg_string_index = 6
-    for solution in solutions:
-        sum_string_index = 0
-        for dict_val in solution.values():
-            sum_string_index += dict_val.string_index
-        avg_string_index = sum_string_index / len(solution)
-        if avg_string_index < min_avg_string_index:
-            min_solution = solution
-            min_avg_string_index = avg_string_index
-
-    return min_solution
+            kept_pitches = find_playable_subset(pitches, guitar_index, drop_priority)
+            if profiler is not None:
+                profiler.count("fallback_searches")
+            kept_voicing = find_pitch_voicing(kept_pitches, guitar_index, voicing_cache, solution_counts)
+            if voicing_cache is not None:
+                voicing_cache.put_subset(pitches, drop_priority, kept_pitches, kept_voicing)
+        if profiler is not None:
+            profiler.count("notes_dropped_unplayable", len(pitches) - len(kept_pitches))
+        if dropped_notes is not None:
+            dropped_notes.extend((quarter_beat_index, pitch) for pitch in pitches if pitch not in kept_pitches)
+        pitches, voicing = kept_pitches, kept_voicing
+    count_chord_solved(simultaneous_pitches, solution_counts)
+
+    best_solution = {}
+    for pitch, (string_index, fret) in zip(pitches, voicing):
+        best_solution[str(pitch)] = GuitarNote(guitar_index.string_names[string_index], string_index, fret,
+                                               quarter_beat_index=quarter_beat_index)
+    return best_solution
 
 
-# Checks for bars that are unplayable and removes them from the solution set
-def remove_unplayable_bars(solutions):
-    vetted_solutions = []
+# Given notes to be played simultaneously, chooses the best fingering for them to be played
+def optimize_simultaneous_notes(simultaneous_notes, guitar_index, voicing_cache=None, drop_priority=DROP_PRIORITY,
+                                dropped_notes=None):
+    return optimize_simultaneous_pitches([cur_note.note for cur_note in simultaneous_notes],
+                                         simultaneous_notes[0].quarter_beat_index, guitar_index, voicing_cache,
+                                         drop_priority, dropped_notes)
+
+
+# Yields the chosen way to play the notes of the note table, one quarter beat at a time. Notes left out of
+# unplayable chords are added to dropped_notes, if given
+def generate_guitar_notes(notes_on, guitar_index, voicing_cache=None, drop_priority=DROP_PRIORITY,
+                          dropped_notes=None):
+    pitches = notes_on.pitches.tolist()
+    seconds = notes_on.seconds.tolist()
+    quarter_beat_indexes = notes_on.quarter_beat_indexes.tolist()
+
+    for start, end in notes_on.simultaneous_ranges():
+        if end - start == 1:
+            fingering = guitar_index[pitches[start]][0]
+            yield GuitarNote(guitar_index.string_names[fingering.string_index], fingering.string_index, fingering.fret,
+                             seconds[start], quarter_beat_indexes[start])
 
-    for solution in solutions:
-        fret_nums = []
-        for guitar_note in solution.values():
-            if guitar_note.fret != 0:
-                fret_nums.append(guitar_note.fret)
-        if len(fret_nums) <= 4:
-            vetted_solutions.append(solution)
+        else:
+            playable_notes = optimize_simultaneous_pitches(pitches[start:end], quarter_beat_indexes[start],
+                                                           guitar_index, voicing_cache, drop_priority, dropped_notes)
+            yield from playable_notes.values()
+
+
+# Returns a Tab that has the chosen way to play all notes of the note table
+def translate_notes(notes_on, guitar_index, voicing_cache=None, drop_priority=DROP_PRIORITY):
+    dropped_notes = []
+    guitar_notes = generate_guitar_notes(notes_on, guitar_index, voicing_cache, drop_priority, dropped_notes)
+    return Tab(GuitarNoteTable(guitar_index.string_names, guitar_notes), dropped_notes)
+
+
+# Returns the fret the fretting hand sits at to play a voicing, or None if it only uses open strings
+def hand_position(voicing):
+    frets = [guitar_note.fret for guitar_note in voicing if guitar_note.fret != 0]
+    return sum(frets) / len(frets) if frets else None
+
+
+# Cost of moving the fretting hand between two voicings, open strings can be played from anywhere
+def hand_movement_cost(from_position, to_position):
+    if from_position is None or to_position is None:
+        return 0
+    return HAND_MOVEMENT_COST * abs(from_position - to_position)
+
+
+# Cost of playing a voicing on its own, using the chord solver's preferences and favoring low hand positions
+def voicing_cost(cost, position):
+    unplayable_bar, string_sum, fret_span = cost
+    return UNPLAYABLE_BAR_COST * unplayable_bar + STRING_INDEX_COST * string_sum + FRET_SPAN_COST * fret_span + \
+        (HAND_POSITION_COST * position if position is not None else 0)
+
+
+# Finds the candidate voicings for pitches played at the same time, keeping the largest playable set like
+# optimize_simultaneous_pitches does when they can't all be played. Returns the kept pitches and their voicings,
+# reusing what was already found for a pitch set from found_voicings
+def candidate_voicings(simultaneous_pitches, guitar_index, found_voicings, drop_priority=DROP_PRIORITY):
+    pitches = tuple(sorted(set(simultaneous_pitches)))
+    if pitches not in found_voicings:
+        solution_counts = [] if profiler is not None else None
+        kept_pitches = pitches
+        voicings = find_voicings([guitar_index[pitch] for pitch in pitches], GLOBAL_VOICINGS_PER_CHORD,
+                                 solution_counts)
+        if not voicings:
+            kept_pitches = find_playable_subset(pitches, guitar_index, drop_priority)
+            voicings = find_voicings([guitar_index[pitch] for pitch in kept_pitches], GLOBAL_VOICINGS_PER_CHORD,
+                                     solution_counts)
+            if profiler is not None:
+                profiler.count("fallback_searches")
+        count_chord_solved(simultaneous_pitches, solution_counts)
+        found_voicings[pitches] = (kept_pitches, voicings)
+    if profiler is not None:
+        profiler.count("notes_dropped_unplayable", len(pitches) - len(found_voicings[pitches][0]))
+    return found_voicings[pitches]
+
+
+# Returns a Tab that plays all notes of the note table with the least total hand movement over the whole song.
+# Every quarter beat is a layer of candidate voicings and a Viterbi search finds the cheapest path through
+# them, keeping only the costs of the previous layer and a back-pointer per candidate
+def translate_notes_globally(notes_on, guitar_index, drop_priority=DROP_PRIORITY):
+    pitches = notes_on.pitches.tolist()
+    seconds = notes_on.seconds.tolist()
+    quarter_beat_indexes = notes_on.quarter_beat_indexes.tolist()
+
+    layers = []
+    back_pointers = []
+    previous_costs = None
+    previous_positions = None
+    found_voicings = {}
+    dropped_notes = []
+    for start, end in notes_on.simultaneous_ranges():
+        kept_pitches, voicings = candidate_voicings(pitches[start:end], guitar_index, found_voicings, drop_priority)
+        dropped_notes.extend((quarter_beat_indexes[start], pitch) for pitch in sorted(set(pitches[start:end]))
+                             if pitch not in kept_pitches)
+        positions = [hand_position(voicing) for _, voicing in voicings]
+
+        costs = []
+        pointers = []
+        for (cost, _), position in zip(voicings, positions):
+            best_previous = 0
+            best_cost = 0
+            if previous_costs is not None:
+                best_cost = None
+                for previous_index, previous_cost in enumerate(previous_costs):
+                    path_cost = previous_cost + hand_movement_cost(previous_positions[previous_index], position)
+                    if best_cost is None or path_cost < best_cost:
+                        best_previous = previous_index
+                        best_cost = path_cost
+            costs.append(best_cost + voicing_cost(cost, position))
+            pointers.append(best_previous)
+
+        layers.append((start, end - start, [voicing for _, voicing in voicings]))
+        back_pointers.append(pointers)
+        previous_costs = costs
+        previous_positions = positions
+
+    if not layers:
+        return Tab(GuitarNoteTable(guitar_index.string_names), dropped_notes)
+
+    # Walk the back-pointers from the cheapest final voicing to recover the chosen path
+    chosen_indexes = [0] * len(layers)
+    chosen_indexes[-1] = min(range(len(previous_costs)), key=lambda index: previous_costs[index])
+    for layer_index in range(len(layers) - 1, 0, -1):
+        chosen_indexes[layer_index - 1] = back_pointers[layer_index][chosen_indexes[layer_index]]
+
+    guitar_note_list = GuitarNoteTable(guitar_index.string_names)
+    for (start, num_simultaneous_notes, voicings), chosen_index in zip(layers, chosen_indexes):
+        voicing = voicings[chosen_index]
+        start_time = seconds[start] if num_simultaneous_notes == 1 else 0
+        for string_index, fret in voicing:
+            guitar_note_list.append(string_index, fret, start_time, quarter_beat_indexes[start])
+
+    return Tab(guitar_note_list, dropped_notes)
+
+
+# Chooses how to play the notes of the note table, chord by chord or minimizing hand movement over the whole song.
+# Returns the guitar notes and the notes dropped from unplayable chords. With streaming and chord by chord
+# fingering, the guitar notes are a generator solving each chord as it is pulled, and the dropped notes fill up
+# as it runs
+def choose_guitar_notes(notes_on, guitar_index, voicing_cache, global_fingering, drop_priority=DROP_PRIORITY,
+                        streaming=False):
+    if global_fingering:
+        tab = translate_notes_globally(notes_on, guitar_index, drop_priority)
+    elif streaming:
+        dropped_notes = []
+        return generate_guitar_notes(notes_on, guitar_index, voicing_cache, drop_priority, dropped_notes), \
+            dropped_notes
+    else:
+        tab = translate_notes(notes_on, guitar_index, voicing_cache, drop_priority)
+    return tab.guitar_note_list, tab.dropped_notes
+
+
+# Returns how many measures a song whose last note is on quarter beat last_beat_index takes up: up to the
+# measure holding that note, or one empty measure more if that note ends a measure
+def song_measure_count(last_beat_index, quarter_beats_per_measure):
+    song_end = last_beat_index + quarter_beats_per_measure - (last_beat_index % quarter_beats_per_measure)
+    return -(-song_end // quarter_beats_per_measure)
+
+
+# Renders the six string segments of the measure starting at quarter beat measure_start, high e string first,
+# from its guitar notes sorted by quarter beat. note_just_played tells whether the last quarter beat of the
+# measure before had notes. Returns the segments, whether the last quarter beat of this measure had notes and
+# the quarter beat of the last note placed, or None if none were
+def render_measure(guitar_notes, measure_start, quarter_beats_per_measure, note_just_played):
+    guitar_notes = iter(guitar_notes)
+    next_note = next(guitar_notes, None)
+    last_beat_index = None
+    measure_end = measure_start + quarter_beats_per_measure - 1
+    segments = [[], [], [], [], [], []]
+    for time_index in range(measure_start, measure_end + 1):
+        # notes out of order can't be placed any more
+        while next_note is not None and next_note.quarter_beat_index < time_index:
+            next_note = next(guitar_notes, None)
+        if next_note is None or next_note.quarter_beat_index != time_index:
+            # no notes at this time tick
+            for segment in segments:
+                segment.append("-")
+            note_just_played = False
             continue
-        necessary_bar_len = 2 if len(fret_nums) == 5 else 3
-        for x in range(1, 15):
-            if fret_nums.count(x) >= necessary_bar_len:
-                vetted_solutions.append(solution)
-                break
-            elif fret_nums.count(x) == 1:
-                break
 
-    return vetted_solutions
+        # catches notes on this time tick
+        frets = ["", "", "", "", "", ""]
+        while next_note is not None and next_note.quarter_beat_index == time_index:
+            frets[next_note.string_index] += str(next_note.fret)
+            last_beat_index = next_note.quarter_beat_index
+            next_note = next(guitar_notes, None)
+
+        # separate from notes on the time tick before, and pad every string to the widest fret number (10-17)
+        width = max(len(fret) for fret in frets)
+        for segment, fret in zip(segments, frets):
+            if note_just_played:
+                segment.append("-")
+            segment.append(fret)
+            segment.append("-" * (width - len(fret)))
+        note_just_played = True
+
+    for segment in segments:
+        segment.append("|")
+    return ["".join(segment) for segment in segments], note_just_played, last_beat_index
+
+
+# Yields the six string segments of each measure, high e string first, from guitar notes sorted by quarter beat.
+# Notes are only pulled from guitar_notes as the measure they are in is rendered, so it can be a generator
+def render_measures(guitar_notes, quarter_beats_per_measure):
+    guitar_notes = iter(guitar_notes)
+    next_note = next(guitar_notes, None)
+    if next_note is None:
+        return
 
+    note_just_played = False
+    measure_start = 1
+    last_beat_index = next_note.quarter_beat_index
+    while True:
+        measure_end = measure_start + quarter_beats_per_measure - 1
+        measure_notes = []
+        while next_note is not None and next_note.quarter_beat_index <= measure_end:
+            measure_notes.append(next_note)
+            next_note = next(guitar_notes, None)
+        segments, note_just_played, last_placed = render_measure(measure_notes, measure_start,
+                                                                 quarter_beats_per_measure, note_just_played)
+        if last_placed is not None:
+            last_beat_index = last_placed
+        yield segments
+
+        if next_note is None and \
+                measure_end // quarter_beats_per_measure >= song_measure_count(last_beat_index,
+                                                                               quarter_beats_per_measure):
+            return
+        measure_start = measure_end + 1
+
+
+# Groups the segments of each measure into lines of the tab no wider than 132 characters, yielding the numbers
+# of the first and last measure of each line and its strings, each a list of the string name and its segments
+def group_tab_lines(measures, quarter_beats_per_measure, tuning_offset):
+    low_e_string_name = NOTE_NAMES[((40 + tuning_offset) % 12)]
 
-# Given notes to be played simultaneously, chooses the best fingering for them to be played
-def optimize_simultaneous_notes(simultaneous_notes, guitar_index):
-    problem = Problem()
-
-    variables = []
-    for cur_note in simultaneous_notes:
-        if str(cur_note.note) not in variables:
-            variables.append(str(cur_note.note))
-            potential_guitar_notes = copy.deepcopy(guitar_index[cur_note.note])
-            for guitar_note in potential_guitar_notes:
-                guitar_note.quarter_beat_index = cur_note.quarter_beat_index
-            problem.addVariable(str(cur_note.note), potential_guitar_notes)
-
-    for i in range(len(variables)):
-        for j in range(i + 1, len(variables)):
-            # Add a constraint function that checks if the absolute difference is <= 4
-            def fret_constraint_function(a, b):
-                return abs(a.fret - b.fret) <= 4 or \
-                       (a.fret == 0 and abs(a.fret - b.fret) <= 7) or \
-                       (b.fret == 0 and abs(a.fret - b.fret) <= 7)
-
-            # Add a constraint function that checks if the strings are different
-            def string_constraint_function(a, b):
-                return a.string_index != b.string_index
-
-            # Add the constraints to the problem
-            problem.addConstraint(fret_constraint_function, (variables[i], variables[j]))
-            problem.addConstraint(string_constraint_function, (variables[i], variables[j]))
-
-    solutions = problem.getSolutions()
-    if len(solutions) == 0:
-        simultaneous_notes.pop(1)
-        return optimize_simultaneous_notes(simultaneous_notes, guitar_index)
-
-    best_solution = pick_min_string_index(solutions)
-
-    solutions = remove_unplayable_bars(solutions)
-
-    if solutions:
-        best_solution = pick_min_string_index(solutions)
-
-    return best_solution
-
+    empty_guitar_strings = ["e|", "B|", "G|", "D|", "A|", low_e_string_name + "|"] \
+        if len(low_e_string_name) == 1 \
+        else ["e |", "B |", "G |", "D |", "A |", low_e_string_name + "|"]
 
-# Returns a Tab that has the chosen way to play all notes
-def translate_notes(notes_on, guitar_index):
-    guitar_note_list = []
-    note_index = 0
-    while note_index < len(notes_on):
-        current_note = notes_on[note_index]
+    guitar_strings = [[guitar_string] for guitar_string in empty_guitar_strings]
+    line_len = len(empty_guitar_strings[0])
+    line_measure_number = 1
+    measure_number = 0
+    for measure_number, segments in enumerate(measures, 1):
+        for guitar_string, segment in zip(guitar_strings, segments):
+            guitar_string.append(segment)
+        line_len += len(segments[0])
+        if line_len + quarter_beats_per_measure > 132:
+            yield line_measure_number, measure_number, guitar_strings
+            line_measure_number = measure_number + 1
+            guitar_strings = [[guitar_string] for guitar_string in empty_guitar_strings]
+            line_len = len(empty_guitar_strings[0])
+
+    if line_len > 3:
+        yield line_measure_number, measure_number, guitar_strings
+
+
+# Given the chosen guitar notes, yields the human-readable tab one line of measures at a time
+def render_tab(guitar_notes, time_sig_numerator, time_sig_denominator, tuning_offset):
+    quarter_beats_per_measure = time_sig_numerator * time_sig_denominator
+    for line_measure_number, _, guitar_strings in group_tab_lines(
+            render_measures(guitar_notes, quarter_beats_per_measure), quarter_beats_per_measure, tuning_offset):
+        yield render_tab_line(line_measure_number, guitar_strings)
 
-        i = 1
-        current_quarter_beat_index = current_note.quarter_beat_index
-        simultaneous_notes = [current_note]
-        while note_index + i < len(notes_on) and \
-                current_quarter_beat_index == notes_on[note_index + i].quarter_beat_index:
-            simultaneous_notes.append(notes_on[note_index + i])
-            i += 1
-        note_index += i
 
-        if len(simultaneous_notes) == 1:
-            guitar_note = guitar_index[current_note.note][0]
-            guitar_note_list.append(GuitarNote(guitar_note.string_name, guitar_note.string_index, guitar_note.fret,
-                                               current_note.time, current_note.quarter_beat_index))
+# Renders one line of the tab, headed by the number of its first measure
+def render_tab_line(line_measure_number, guitar_strings):
+    return f"{line_measure_number}\n" + \
+        "".join("".join(guitar_string) + "\n" for guitar_string in guitar_strings) + "\n"
 
-        else:
-            playable_notes = optimize_simultaneous_notes(simultaneous_notes, guitar_index)
-            guitar_note_list.extend(playable_notes.values())
 
-    return Tab(guitar_note_list)
+# Writes the human-readable tab of the chosen guitar notes to a file-like object, line by line as it is rendered
+def write_tab(output, guitar_notes, time_sig_numerator, time_sig_denominator, tuning_offset):
+    for tab_line in render_tab(guitar_notes, time_sig_numerator, time_sig_denominator, tuning_offset):
+        output.write(tab_line)
 
 
-# Print one line of the tab
-def print_tab_line(guitar_strings):
-    for guitar_string in guitar_strings:
-        print(guitar_string)
-    print()
+# Writes the notes left out of unplayable chords, one chord per line
+def write_dropped_notes(output, dropped_notes, label=""):
+    if not dropped_notes:
+        return
+    output.write(f"{label}Dropped {len(dropped_notes)} notes from unplayable chords:\n")
+    for quarter_beat_index, chord_notes in itertools.groupby(dropped_notes, key=lambda dropped_note: dropped_note[0]):
+        output.write(f"  quarter beat {quarter_beat_index}: "
+                     f"{' '.join(note_number_to_name(pitch) for _, pitch in chord_notes)}\n")
 
 
 # Given the Tab with the chosen notes, creates the human-readable tab and prints it
 def print_tab(tab, time_sig_numerator, time_sig_denominator, tuning_offset):
-    note_names = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    low_e_string_name = note_names[((40 + tuning_offset) % 12)]
+    write_tab(sys.stdout, tab.guitar_note_list, time_sig_numerator, time_sig_denominator, tuning_offset)
+
+
+# Worker process state for tabbing channels, set up once per process so the guitar index is only sent once
+channel_worker = {}
+
+
+def init_channel_worker(guitar_index, voicing_cache):
+    channel_worker["guitar_index"] = guitar_index
+    channel_worker["voicing_cache"] = voicing_cache
+
+
+# Renders the tab of one channel headed by its label, using the guitar index of this worker.
+# Returns the tab and the notes dropped from unplayable chords
+def tab_channel(label, note_events, channel, time_info_dict, guitar_range, tuning_offset, global_fingering,
+                drop_priority=DROP_PRIORITY):
+    guitar_index = channel_worker["guitar_index"]
+    notes_on = create_notes(note_events, time_info_dict, guitar_range, channel)
+    guitar_notes, dropped_notes = choose_guitar_notes(notes_on, guitar_index, channel_worker["voicing_cache"],
+                                                      global_fingering, drop_priority, streaming=True)
+
+    channel_tab = io.StringIO()
+    channel_tab.write(label)
+    write_tab(channel_tab, guitar_notes, time_info_dict["time_sig_numerator"], time_info_dict["time_sig_denominator"],
+              tuning_offset)
+    return channel_tab.getvalue(), dropped_notes
+
+
+# Tabs every channel of the song that has notes, largest first, each headed by its channel and instrument.
+# With more than one worker the channels are tabbed in parallel processes
+def tab_all_channels(song_scan, guitar_index, guitar_range, voicing_cache, tuning_offset, global_fingering, workers,
+                     output, drop_priority=DROP_PRIORITY, dropped_output=None):
+    jobs = []
+    for instrument, channel_length, channel in get_channel_info(song_scan):
+        label = f"Channel {channel}: {instrument} ({channel_length} notes)\n\n"
+        jobs.append((label, song_scan.channel_notes[channel], channel, song_scan.time_info_dict, guitar_range,
+                     tuning_offset, global_fingering, drop_priority))
+
+    # No worker count means one per CPU, a single CPU tabs in this process
+    workers = workers if workers is not None else os.cpu_count() or 1
+    with contextlib.ExitStack() as stack:
+        if workers <= 1 or len(jobs) <= 1:
+            init_channel_worker(guitar_index, voicing_cache)
+            channel_tabs = (tab_channel(*job) for job in jobs)
+        else:
+            # Workers start from a copy of the voicing cache, what they learn is not brought back
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=init_channel_worker, initargs=(guitar_index, voicing_cache)))
+            channel_tabs = executor.map(tab_channel, *zip(*jobs))
+
+        for job, (channel_tab, dropped_notes) in zip(jobs, channel_tabs):
+            output.write(channel_tab)
+            if dropped_output is not None:
+                write_dropped_notes(dropped_output, dropped_notes, f"Channel {job[2]}: ")
+
+
+# Total distance the fretting hand moves over the guitar notes, sorted by quarter beat
+def fret_movement(guitar_notes):
+    movement = 0
+    previous_position = None
+    for _, voicing in itertools.groupby(guitar_notes, key=lambda guitar_note: guitar_note.quarter_beat_index):
+        position = hand_position(list(voicing))
+        if position is not None:
+            if previous_position is not None:
+                movement += abs(position - previous_position)
+            previous_position = position
+    return movement
+
+
+# Tabs the notes with one tuning and capo, returning
+# (tuning_offset, capo_offset, notes in range, notes dropped from unplayable chords, fret movement)
+def score_configuration(notes_on, tuning_offset, capo_offset, global_fingering=False, drop_priority=DROP_PRIORITY):
+    guitar_index, guitar_range = create_guitar_index(tuning_offset, capo_offset)
+    notes_on = notes_on.in_range(guitar_range)
+    guitar_notes, dropped_notes = choose_guitar_notes(notes_on, guitar_index, VoicingCache(tuning_offset, capo_offset),
+                                                      global_fingering, drop_priority)
+    return tuning_offset, capo_offset, len(notes_on), len(dropped_notes), fret_movement(guitar_notes)
+
+
+# Scores every tuning and capo for the notes, in parallel processes when there is more than one worker.
+# Returns the scores best first: most notes played, then least fret movement
+def sweep_configurations(notes_on, configurations, global_fingering=False, workers=None, drop_priority=DROP_PRIORITY):
+    configurations = list(configurations)
+    # No worker count means one per CPU, a single CPU scores in this process
+    workers = workers if workers is not None else os.cpu_count() or 1
+    if workers <= 1:
+        scores = [score_configuration(notes_on, tuning_offset, capo_offset, global_fingering, drop_priority)
+                  for tuning_offset, capo_offset in configurations]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            scores = list(executor.map(score_configuration, itertools.repeat(notes_on),
+                                       [tuning_offset for tuning_offset, _ in configurations],
+                                       [capo_offset for _, capo_offset in configurations],
+                                       itertools.repeat(global_fingering), itertools.repeat(drop_priority)))
+    return sorted(scores, key=lambda score: (-(score[2] - score[3]), score[4]))
+
+
+# Writes the ranked table of sweep scores
+def write_sweep_table(output, scores):
+    output.write("Rank  Tuning  Capo  In range  Dropped  Played  Fret movement\n")
+    for rank, (tuning_offset, capo_offset, notes_in_range, dropped, movement) in enumerate(scores, 1):
+        output.write(f"{rank:4d}  {tuning_offset:6d}  {capo_offset:4d}  {notes_in_range:8d}  {dropped:7d}  "
+                     f"{notes_in_range - dropped:6d}  {movement:13.1f}\n")
+    output.write("\n")
+
+
+# Splits the quantized note groups of a note table by measure, each group being [quarter_beat_index, pitches]
+def measure_note_groups(notes_on, quarter_beats_per_measure):
+    pitches = notes_on.pitches.tolist()
+    quarter_beat_indexes = notes_on.quarter_beat_indexes.tolist()
+    measures = []
+    for start, end in notes_on.simultaneous_ranges():
+        measure_index = (quarter_beat_indexes[start] - 1) // quarter_beats_per_measure
+        while len(measures) <= measure_index:
+            measures.append([])
+        measures[measure_index].append([quarter_beat_indexes[start], pitches[start:end]])
+    return measures
+
+
+# Content hash of the note groups of one measure
+def measure_hash(note_groups):
+    return hashlib.blake2b(json.dumps(note_groups).encode(), digest_size=12).hexdigest()
+
+
+# Loads the state saved by the last incremental run, or None if there is none or it was made with other settings
+def load_incremental_state(state_file, settings):
+    if not os.path.isfile(state_file):
+        return None
+    with open(state_file) as f:
+        state = json.load(f)
+    if state.get("version") != INCREMENTAL_STATE_VERSION or state.get("settings") != settings:
+        return None
+    return state
+
+
+# Tabs the notes reusing what the run saved in state_file solved and rendered, so only the measures whose notes
+# changed and INCREMENTAL_BOUNDARY_MEASURES either side of them are solved again, and only the lines holding
+# measures that render differently are put together again. Saves the state for the next run and returns
+# (measures solved, measures, lines rendered, lines, notes dropped from unplayable chords)
+def tab_incrementally(notes_on, guitar_index, voicing_cache, time_info_dict, tuning_offset, global_fingering,
+                      drop_priority, settings, state_file, output):
+    quarter_beats_per_measure = time_info_dict["time_sig_numerator"] * time_info_dict["time_sig_denominator"]
+    note_groups = measure_note_groups(notes_on, quarter_beats_per_measure)
+    hashes = [measure_hash(groups) for groups in note_groups]
+
+    state = load_incremental_state(state_file, settings)
+    old_measures = state["measures"] if state is not None else []
+    old_lines = {line[0]: line for line in state["lines"]} if state is not None else {}
+
+    # Solve the changed measures and their neighbours again, all at once so the whole-song search sees them together
+    changed = {index for index, measure_hash_value in enumerate(hashes)
+               if index >= len(old_measures) or old_measures[index]["hash"] != measure_hash_value}
+    to_solve = sorted({neighbour for index in changed
+                       for neighbour in range(index - INCREMENTAL_BOUNDARY_MEASURES,
+                                              index + INCREMENTAL_BOUNDARY_MEASURES + 1)
+                       if 0 <= neighbour < len(hashes)})
+    with profile_stage("translate"):
+        note_measures = (notes_on.quarter_beat_indexes - 1) // quarter_beats_per_measure
+        solved_notes = notes_on.take(np.isin(note_measures, to_solve))
+        guitar_notes, dropped_notes = choose_guitar_notes(solved_notes, guitar_index, voicing_cache, global_fingering,
+                                                          drop_priority)
+
+    fingerings = {index: [] for index in to_solve}
+    for guitar_note in guitar_notes:
+        fingerings[(guitar_note.quarter_beat_index - 1) // quarter_beats_per_measure].append(
+            [guitar_note.quarter_beat_index, guitar_note.string_index, guitar_note.fret])
+    dropped = {index: [] for index in to_solve}
+    for quarter_beat_index, pitch in dropped_notes:
+        dropped[(quarter_beat_index - 1) // quarter_beats_per_measure].append([quarter_beat_index, pitch])
+
+    measures = []
+    for index, measure_hash_value in enumerate(hashes):
+        if index in fingerings:
+            measures.append({"hash": measure_hash_value, "groups": note_groups[index],
+                             "fingerings": fingerings[index], "dropped": dropped[index]})
+        else:
+            measures.append(dict(old_measures[index]))
 
-    empty_guitar_strings = ["e|", "B|", "G|", "D|", "A|", low_e_string_name + "|"] \
-        if len(low_e_string_name) == 1 \
-        else ["e |", "B |", "G |", "D |", "A |", low_e_string_name + "|"]
-    guitar_strings = empty_guitar_strings.copy()
+    num_measures = song_measure_count(note_groups[-1][-1][0], quarter_beats_per_measure) if note_groups else 0
+    while len(measures) < num_measures:
+        index = len(measures)
+        if index < len(old_measures) and old_measures[index]["hash"] == measure_hash([]):
+            measures.append(dict(old_measures[index]))
+        else:
+            measures.append({"hash": measure_hash([]), "groups": [], "fingerings": [], "dropped": []})
+
+    # Render a measure again when it was solved again or the measure before it now ends differently
+    with profile_stage("render"):
+        note_just_played = False
+        rendered = set()
+        for index, measure in enumerate(measures):
+            old_measure = old_measures[index] if index < len(old_measures) else None
+            if index in fingerings or old_measure is None or "segments" not in old_measure or \
+                    old_measure["played_before"] != note_just_played:
+                guitar_notes = [GuitarNote(guitar_index.string_names[string_index], string_index, fret,
+                                           quarter_beat_index=quarter_beat_index)
+                                for quarter_beat_index, string_index, fret in measure["fingerings"]]
+                segments, played_after, _ = render_measure(guitar_notes, index * quarter_beats_per_measure + 1,
+                                                           quarter_beats_per_measure, note_just_played)
+                if old_measure is None or old_measure.get("segments") != segments:
+                    rendered.add(index)
+                measure.update(segments=segments, played_before=note_just_played, played_after=played_after)
+            note_just_played = measure["played_after"]
+
+        lines = []
+        lines_rendered = 0
+        for first, last, guitar_strings in group_tab_lines((measure["segments"] for measure in measures[:num_measures]),
+                                                           quarter_beats_per_measure, tuning_offset):
+            old_line = old_lines.get(first)
+            if old_line is not None and old_line[1] == last and not rendered.intersection(range(first - 1, last)):
+                text = old_line[2]
+            else:
+                text = render_tab_line(first, guitar_strings)
+                lines_rendered += 1
+            lines.append([first, last, text])
+            output.write(text)
 
-    quarter_beats_per_measure = time_sig_numerator * time_sig_denominator
-    last_beat_index = tab.guitar_note_list[-1].quarter_beat_index
-    song_len = last_beat_index + quarter_beats_per_measure - (last_beat_index % quarter_beats_per_measure) + 1
-    note_index = 0
-    note_just_played = False
-    measure_number = 1
-    line_measure_number = measure_number
-    for time_index in range(1, song_len):
-        # to account for fret nums > 2 characters long (10-17), and no notes at this time tick
-        max_string_len = len(guitar_strings[0]) + 1
-        current_guitar_note = tab.guitar_note_list[note_index] if note_index < len(tab.guitar_note_list) else None
-        if note_just_played:
-            if current_guitar_note and current_guitar_note.quarter_beat_index == time_index:
-                for guitar_string_index in range(len(guitar_strings)):
-                    guitar_strings[guitar_string_index] += "-"
-            note_just_played = False
+    temp_file = f"{state_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"version": INCREMENTAL_STATE_VERSION, "settings": settings, "measures": measures[:num_measures],
+                   "lines": lines}, f)
+    os.replace(temp_file, state_file)
 
-        while current_guitar_note and current_guitar_note.quarter_beat_index == time_index:
-            # catches notes on this time tick
-            fret = str(current_guitar_note.fret)
-            guitar_strings[current_guitar_note.string_index] += fret
-            max_string_len = max(max_string_len, len(guitar_strings[current_guitar_note.string_index]))
-            note_index += 1
-            current_guitar_note = tab.guitar_note_list[note_index] if note_index < len(tab.guitar_note_list) else None
-            note_just_played = True
-
-        for guitar_string_index in range(len(guitar_strings)):
-            # add dashes to strings that don't have notes at this time tick
-            if len(guitar_strings[guitar_string_index]) < max_string_len:
-                num_dashes = (max_string_len - len(guitar_strings[guitar_string_index]))
-                guitar_strings[guitar_string_index] += ("-" * num_dashes)
-
-        if time_index > 0 and time_index % quarter_beats_per_measure == 0:
-            measure_number += 1
-            for guitar_string_index in range(len(guitar_strings)):
-                guitar_strings[guitar_string_index] += "|"
-        if time_index > 0 and time_index % quarter_beats_per_measure == 0 and \
-                len(guitar_strings[0]) + quarter_beats_per_measure > 132:
-            print(line_measure_number)
-            print_tab_line(guitar_strings)
-            line_measure_number = measure_number
-            guitar_strings = empty_guitar_strings.copy()
-
-    if len(guitar_strings[0]) > 3:
-        print(line_measure_number)
-        print_tab_line(guitar_strings)
-
-
-def main(midi_file, channel_num, tuning_offset, capo_offset):
-    # Create guitar index with note keys -- fret-string values
-    guitar_index, guitar_range = create_guitar_index(tuning_offset, capo_offset)
+    return len(to_solve), num_measures, lines_rendered, len(lines), \
+        [tuple(dropped_note) for measure in measures for dropped_note in measure["dropped"]]
 
-    # Read in the song
-    midi_song = MidiFile(midi_file, clip=True)
 
-    # Capture important info from song
-    time_info_dict = create_time_info_dict(midi_song)
+def main(midi_file, channel_num, tuning_offset, capo_offset, voicing_cache_file=None, global_fingering=False,
+         raw_reader=False, output=None, workers=1, sweep=False, fingering_tables_file=None,
+         drop_priority=DROP_PRIORITY, dropped_output=None, incremental_file=None):
+    # Load the fingering tables saved by earlier runs so they aren't built again
+    if fingering_tables_file is not None and os.path.isfile(fingering_tables_file):
+        load_fingering_tables(fingering_tables_file)
+    known_tables = len(fingering_tables)
 
-    # Split song into tracks for single track translation
-    single_track = song_to_tracks(midi_song, channel_num)
+    # Create guitar index with note keys -- fret-string values
+    guitar_index, guitar_range = create_guitar_index(tuning_offset, capo_offset)
 
-    # Read from the single track and put notes into structures
-    notes_on = create_notes(single_track, time_info_dict, guitar_range)
+    # Remember chord voicings so repeated chords are only solved once, optionally warm from earlier runs
+    voicing_cache = VoicingCache(tuning_offset, capo_offset, cache_file=voicing_cache_file)
+
+    # Read in the song, capturing its timing info and the notes of every channel in one pass
+    with profile_stage("scan"):
+        song_scan = read_song(midi_file, raw_reader)
+    time_info_dict = song_scan.time_info_dict
+    output = output if output is not None else sys.stdout
+
+    if sweep:
+        # Score every tuning and capo on the channel's notes, quantized once, then tab it with the best one
+        channel_num = select_channel(song_scan, channel_num)
+        notes_on = create_notes(song_scan.channel_notes.get(channel_num, NoteEvents()), time_info_dict, (0, 127),
+                                channel_num)
+        with profile_stage("sweep"):
+            scores = sweep_configurations(notes_on, itertools.product(SWEEP_TUNING_OFFSETS, SWEEP_CAPO_OFFSETS),
+                                          global_fingering, workers, drop_priority)
+        write_sweep_table(output, scores)
+
+        tuning_offset, capo_offset = scores[0][0], scores[0][1]
+        output.write(f"Best: tuning offset {tuning_offset}, capo {capo_offset}\n\n")
+        guitar_index, guitar_range = create_guitar_index(tuning_offset, capo_offset)
+        voicing_cache = VoicingCache(tuning_offset, capo_offset, cache_file=voicing_cache_file)
+        notes_on = notes_on.in_range(guitar_range)
+        guitar_notes, dropped_notes = choose_guitar_notes(notes_on, guitar_index, voicing_cache, global_fingering,
+                                                          drop_priority, streaming=True)
+        write_tab(output, guitar_notes, time_info_dict["time_sig_numerator"], time_info_dict["time_sig_denominator"],
+                  tuning_offset)
+        if dropped_output is not None:
+            write_dropped_notes(dropped_output, dropped_notes)
+    elif channel_num == ALL_CHANNELS:
+        # Tab every channel from the one scan, sharing the guitar index. Counters are only collected from
+        # channels tabbed in this process
+        with profile_stage("tab_channels"):
+            tab_all_channels(song_scan, guitar_index, guitar_range, voicing_cache, tuning_offset, global_fingering,
+                             workers, output, drop_priority, dropped_output)
+    else:
+        # Pick the single channel to translate
+        channel_num = select_channel(song_scan, channel_num)
+
+        # Read from the channel's note events and put notes into structures
+        with profile_stage("create_notes"):
+            notes_on = create_notes(song_scan.channel_notes.get(channel_num, NoteEvents()), time_info_dict,
+                                    guitar_range, channel_num)
+
+        # Translate the notes we read from the track into guitar notes, either chord by chord as the tab is
+        # rendered or minimizing hand movement over the whole song before any of it is rendered
+        if incremental_file is not None:
+            # Only solve and render again what changed since the run that saved incremental_file
+            settings = {"channel": channel_num, "tuning_offset": tuning_offset, "capo_offset": capo_offset,
+                        "global_fingering": global_fingering, "drop_priority": drop_priority,
+                        "time_signature": [time_info_dict["time_sig_numerator"],
+                                           time_info_dict["time_sig_denominator"]]}
+            solved, num_measures, lines_rendered, num_lines, dropped_notes = tab_incrementally(
+                notes_on, guitar_index, voicing_cache, time_info_dict, tuning_offset, global_fingering,
+                drop_priority, settings, incremental_file, output)
+            print(f"Solved {solved} of {num_measures} measures, rendered {lines_rendered} of {num_lines} lines",
+                  file=sys.stderr)
+        else:
+            with profile_stage("translate"):
+                # When profiling, every chord is solved before rendering so the two stages are timed apart
+                guitar_notes, dropped_notes = choose_guitar_notes(notes_on, guitar_index, voicing_cache,
+                                                                  global_fingering, drop_priority,
+                                                                  streaming=profiler is None)
+
+            # Write the generated tab into expected readable output, stdout by default
+            with profile_stage("render"):
+                write_tab(output, guitar_notes, time_info_dict["time_sig_numerator"],
+                          time_info_dict["time_sig_denominator"], tuning_offset)
+        if dropped_output is not None:
+            write_dropped_notes(dropped_output, dropped_notes)
+
+    if voicing_cache_file is not None:
+        voicing_cache.save()
+    if fingering_tables_file is not None and len(fingering_tables) > known_tables:
+        save_fingering_tables(fingering_tables_file)
 
-    # Create the list of guitar notes translated from the paired notes we read from the track-file
-    guitar_tab = translate_notes(notes_on, guitar_index)
+    return
 
-    # Print the generated tab into expected readable output
-    print_tab(guitar_tab, time_info_dict["time_sig_numerator"], time_info_dict["time_sig_denominator"], tuning_offset)
 
-    return
+# Collects the midi files in a directory, or the files matching a glob pattern
+def find_midi_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.mid")) + glob.glob(os.path.join(path, "*.midi")))
+    return sorted(glob.glob(path))
+
+
+# Tabs one midi file into a text file, returning how many seconds it took and the error that stopped it, if any
+def tab_file(midi_file, output_file, channel_num, tuning_offset, capo_offset, **options):
+    start = time.perf_counter()
+    try:
+        with open(output_file, "w") as f:
+            main(midi_file, channel_num, tuning_offset, capo_offset, output=f, **options)
+        error = None
+    # A bad file must not take down the rest of the batch
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        # Don't leave a partial tab behind
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+    return time.perf_counter() - start, error
+
+
+# Tabs every midi file in a directory or matching a glob pattern on a pool of worker processes,
+# writing <output_dir>/<song name>.txt for each one and printing a summary of the run
+def batch_main(path, output_dir, workers, channel_num, tuning_offset, capo_offset, **options):
+    midi_files = find_midi_files(path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for midi_file in midi_files:
+            output_file = os.path.join(output_dir, os.path.splitext(os.path.basename(midi_file))[0] + ".txt")
+            futures[executor.submit(tab_file, midi_file, output_file, channel_num, tuning_offset, capo_offset,
+                                    **options)] = midi_file
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                # The worker process itself died
+                results[futures[future]] = (None, f"{type(e).__name__}: {e}" if str(e) else type(e).__name__)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for midi_file in midi_files:
+        file_time, error = results[midi_file]
+        file_time = f"{file_time:8.3f}s" if file_time is not None else "       -"
+        if error is not None:
+            failed += 1
+            print(f"FAIL {file_time}  {midi_file}  {error}")
+        else:
+            print(f"ok   {file_time}  {midi_file}")
+    print(f"{len(midi_files) - failed}/{len(midi_files)} files tabbed into {output_dir} in {elapsed:.2f}s "
+          f"({len(midi_files) / elapsed if elapsed > 0 else 0:.1f} files/s, {workers or os.cpu_count()} workers)")
+    return failed
+
+
+# Converts songs to tabs without going through stdout, keeping the guitar indexes and voicing caches warm
+# from one song to the next. Errors are raised, an invalid channel as InvalidChannelError
+class Converter:
+    def __init__(self, tuning_offset=0, capo_offset=0, global_fingering=False, raw_reader=False,
+                 voicing_cache_file=None, profiler=None, drop_priority=DROP_PRIORITY):
+        self.tuning_offset = tuning_offset
+        self.capo_offset = capo_offset
+        self.global_fingering = global_fingering
+        self.drop_priority = drop_priority
+        self.raw_reader = raw_reader
+        self.voicing_cache_file = voicing_cache_file
+        self.voicing_caches = {}
+        # Every conversion reports to this profiler, if given
+        self.profiler = profiler
+
+    # Returns the voicing cache of a tuning and capo. Every tuning and capo shares the entries, keyed by both,
+    # so they are saved together
+    def voicing_cache(self, tuning_offset, capo_offset):
+        if (tuning_offset, capo_offset) not in self.voicing_caches:
+            voicing_cache = VoicingCache(tuning_offset, capo_offset, cache_file=self.voicing_cache_file)
+            if self.voicing_caches:
+                voicing_cache.voicings = next(iter(self.voicing_caches.values())).voicings
+            self.voicing_caches[(tuning_offset, capo_offset)] = voicing_cache
+        return self.voicing_caches[(tuning_offset, capo_offset)]
+
+    # Scans a song given as a file name or the bytes of a midi file
+    def scan(self, midi):
+        with profile_stage("scan"):
+            if isinstance(midi, (bytes, bytearray, memoryview)):
+                return read_song_bytes(midi, self.raw_reader)
+            return read_song(midi, self.raw_reader)
+
+    # Tabs one channel of a scanned song
+    def tab_channel(self, song_scan, channel, instrument, tuning_offset, capo_offset):
+        guitar_index, guitar_range = create_guitar_index(tuning_offset, capo_offset)
+        time_info_dict = song_scan.time_info_dict
+        with profile_stage("create_notes"):
+            notes_on = create_notes(song_scan.channel_notes.get(channel, NoteEvents()), time_info_dict, guitar_range,
+                                    channel)
+        with profile_stage("translate"):
+            tab = Tab(*choose_guitar_notes(notes_on, guitar_index, self.voicing_cache(tuning_offset, capo_offset),
+                                           self.global_fingering, self.drop_priority))
+
+        with profile_stage("render"):
+            text = "".join(render_tab(tab.guitar_note_list, time_info_dict["time_sig_numerator"],
+                                      time_info_dict["time_sig_denominator"], tuning_offset))
+        return TabResult(channel, instrument, tuning_offset, capo_offset, time_info_dict["time_sig_numerator"],
+                         time_info_dict["time_sig_denominator"], tab, text)
+
+    # Tabs one channel of a song, -1 choosing the channel with the most messages. The converter's tuning
+    # and capo are used unless others are given
+    def convert(self, midi, channel_num=-1, tuning_offset=None, capo_offset=None):
+        with profiling(self.profiler):
+            song_scan = self.scan(midi)
+            channel = select_channel(song_scan, channel_num)
+            # Channel 9 is the General MIDI percussion channel, the others play their last program
+            instrument = "Drums" if channel == 9 else INSTRUMENTS[song_scan.channel_programs.get(channel, 0)]
+            return self.tab_channel(song_scan, channel, instrument,
+                                    self.tuning_offset if tuning_offset is None else tuning_offset,
+                                    self.capo_offset if capo_offset is None else capo_offset)
+
+    # Tabs every channel of a song that has notes, largest first
+    def convert_all_channels(self, midi, tuning_offset=None, capo_offset=None):
+        with profiling(self.profiler):
+            song_scan = self.scan(midi)
+            return [self.tab_channel(song_scan, channel, instrument,
+                                     self.tuning_offset if tuning_offset is None else tuning_offset,
+                                     self.capo_offset if capo_offset is None else capo_offset)
+                    for instrument, _, channel in get_channel_info(song_scan)]
+
+    # Saves the voicings learned so far to the voicing cache file, if there is one
+    def save(self):
+        if self.voicing_cache_file is not None and self.voicing_caches:
+            next(iter(self.voicing_caches.values())).save()
+
+
+# Answers the tab requests of one connection to the tab server. A request is a JSON header line, like
+# {"length": 1234, "channel": -1, "tuning_offset": 0, "capo_offset": 0}, followed by length bytes of a midi file.
+# Each gets one JSON line back, {"ok": true, "tabs": [{"channel": ..., "instrument": ..., "tab": ...,
+# "dropped": [[quarter_beat_index, pitch], ...]}]}
+# or {"ok": false, "error": ...}. The channel may also be "all"
+async def handle_tab_requests(converter, executor, reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            header = await reader.readline()
+            if not header:
+                return
+            try:
+                request = json.loads(header)
+                data = await reader.readexactly(request["length"])
+            except asyncio.IncompleteReadError:
+                return
+            except (ValueError, KeyError, TypeError) as e:
+                # Without a length the rest of the connection can't be read
+                writer.write(json.dumps({"ok": False, "error": f"bad request header: {e}"}).encode() + b"\n")
+                await writer.drain()
+                return
+
+            channel_num = request.get("channel", -1)
+            tuning_offset = request.get("tuning_offset")
+            capo_offset = request.get("capo_offset")
+            if channel_num != ALL_CHANNELS and (not isinstance(channel_num, int) or isinstance(channel_num, bool)):
+                # The midi file was read, so the connection can go on with the next request
+                writer.write(json.dumps({"ok": False, "error": f"bad request header: channel must be a number or "
+                                                               f"\"{ALL_CHANNELS}\", not {channel_num!r}"}).encode()
+                             + b"\n")
+                await writer.drain()
+                continue
+            try:
+                # The converter runs on a single thread so its caches are never used by two requests at once
+                if channel_num == ALL_CHANNELS:
+                    results = await loop.run_in_executor(executor, converter.convert_all_channels, data,
+                                                         tuning_offset, capo_offset)
+                else:
+                    results = [await loop.run_in_executor(executor, converter.convert, data, channel_num,
+                                                          tuning_offset, capo_offset)]
+                reply = {"ok": True, "tabs": [{"channel": result.channel, "instrument": result.instrument,
+                                               "tuning_offset": result.tuning_offset,
+                                               "capo_offset": result.capo_offset, "tab": result.text,
+                                               "dropped": result.tab.dropped_notes}
+                                              for result in results]}
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}" if str(e) else type(e).__name__}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+# Serves tabs with one warm converter until cancelled or sent SIGTERM, on a Unix socket path or a host:port
+# address. The learned voicings are saved and the Unix socket removed on the way out
+async def serve_tabs(converter, address):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def handle(reader, writer):
+        await handle_tab_requests(converter, executor, reader, writer)
+
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        server = await asyncio.start_server(handle, host, int(port))
+    else:
+        server = await asyncio.start_unix_server(handle, path=address)
+    loop = asyncio.get_running_loop()
+    # Stop on SIGTERM the way Ctrl-C stops, where the event loop supports signal handlers
+    with contextlib.suppress(NotImplementedError):
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        with contextlib.suppress(NotImplementedError):
+            loop.remove_signal_handler(signal.SIGTERM)
+        executor.shutdown()
+        converter.save()
+        if ":" not in address and os.path.exists(address):
+            os.remove(address)
+
+
+# Asks a tab server for the tabs of the bytes of a midi file, returning the decoded reply
+def request_tabs(address, midi_data, channel_num=-1, tuning_offset=None, capo_offset=None):
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        connection = socket.create_connection((host, int(port)))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+    with connection, connection.makefile("rwb") as stream:
+        header = {"length": len(midi_data), "channel": channel_num, "tuning_offset": tuning_offset,
+                  "capo_offset": capo_offset}
+        stream.write(json.dumps(header).encode() + b"\n")
+        stream.write(midi_data)
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+# Parses a channel number argument, which may also be all
+def parse_channel_number(value):
+    return ALL_CHANNELS if value == ALL_CHANNELS else int(value)
+
+
+# Parses the command line, keeping the original positional usage
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python3 MidiToTabs.py", description="Translate .mid files into guitar tabs.")
+    parser.add_argument("midi_file", nargs="?",
+                        help="the .mid file, or with --batch a directory or glob pattern of them")
+    parser.add_argument("channel_number", nargs="?", type=parse_channel_number, default=-1,
+                        help="-1 means choose the longest channel, all tabs every channel")
+    parser.add_argument("tuning_offset", nargs="?", type=int, default=0,
+                        help="0 means regular tuning for low E string")
+    parser.add_argument("capo_fret", nargs="?", type=int, default=0, help="0 means no capo")
+    parser.add_argument("--voicing-cache", metavar="CACHE_FILE",
+                        help="json file to load chord voicings from and save them to between runs")
+    parser.add_argument("--fingering-tables", metavar="TABLES_FILE",
+                        help="binary file to load fingering tables from and save newly built ones to between runs")
+    parser.add_argument("--global", dest="global_fingering", action="store_true",
+                        help="choose fingerings for the whole song at once to minimize hand movement")
+    parser.add_argument("--raw-reader", action="store_true",
+                        help="read the midi file with the built-in byte scanner instead of mido")
+    parser.add_argument("--batch", action="store_true",
+                        help="tab every .mid file in the midi_file directory or glob pattern into --output-dir")
+    parser.add_argument("--output-dir", default="Tabs", help="where --batch writes the tabs, Tabs by default")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes --batch, --sweep or tabbing all channels of one file uses, "
+                             "the number of CPUs by default")
+    parser.add_argument("--sweep", action="store_true",
+                        help="score every low E tuning offset from 0 to -2 and capo from 0 to 7, print them ranked "
+                             "and tab the channel with the best one")
+    parser.add_argument("--drop-priority", choices=DROP_PRIORITIES, default=DROP_PRIORITY,
+                        help="which notes of a chord that can't all be played to keep first: the bass and melody "
+                             "notes (the default), the lowest or the highest")
+    parser.add_argument("--report-dropped", action="store_true",
+                        help="list the notes left out of unplayable chords on stderr")
+    parser.add_argument("--incremental", metavar="STATE_FILE",
+                        help="solve and render again only the measures of the channel that changed since the run "
+                             "that saved STATE_FILE, then save it for the next run")
+    parser.add_argument("--profile", action="store_true",
+                        help="report the time and peak memory of each stage and the solver counters on stderr")
+    parser.add_argument("--profile-format", choices=["text", "json"], default="text",
+                        help="write the --profile report as text or as JSON lines, text by default")
+    parser.add_argument("--list-channels", action="store_true",
+                        help="list the channels with notes and their instruments, largest first, without tabbing")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="serve tabs of midi files sent to a Unix socket path or host:port, keeping the "
+                             "guitar indexes and voicing caches warm between requests")
+    args = parser.parse_args(argv)
+    if args.midi_file is None and args.serve is None:
+        parser.error("the following arguments are required: midi_file")
+    if args.sweep and args.channel_number == ALL_CHANNELS:
+        parser.error("--sweep tabs a single channel, not all")
+    if args.incremental is not None:
+        if args.channel_number == ALL_CHANNELS:
+            parser.error("--incremental tabs a single channel, not all")
+        for option, value in (("--sweep", args.sweep), ("--batch", args.batch), ("--serve", args.serve is not None),
+                              ("--list-channels", args.list_channels)):
+            if value:
+                parser.error(f"--incremental can't be used with {option}")
+    if args.batch:
+        for option, value in (("--profile", args.profile), ("--report-dropped", args.report_dropped),
+                              ("--list-channels", args.list_channels), ("--serve", args.serve is not None)):
+            if value:
+                parser.error(f"--batch can't be used with {option}")
+    return args
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        main(sys.argv[1], -1, 0, 0)
-    elif len(sys.argv) == 3:
-        main(sys.argv[1], int(sys.argv[2]), 0, 0)
-    elif len(sys.argv) == 5:
-        main(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
-
-    else:
-        print("Usages:")
-        print("python3 MidiToTabs.py <midi_file>")
-        print("python3 MidiToTabs.py <midi_file> <channel_number>")
-        print("python3 MidiToTabs.py <midi_file> <channel_number> <tuning_offset> <capo_fret>")
+    args = parse_args(sys.argv[1:])
+    if args.list_channels:
+        for instrument, channel_length, channel in get_channel_info(read_song(args.midi_file, channels_only=True)):
+            print(f"Channel {channel}: {instrument} ({channel_length} notes)")
+        sys.exit(0)
+    if args.batch:
+        failed_files = batch_main(args.midi_file, args.output_dir, args.workers, args.channel_number,
+                                  args.tuning_offset, args.capo_fret, voicing_cache_file=args.voicing_cache,
+                                  global_fingering=args.global_fingering, raw_reader=args.raw_reader,
+                                  fingering_tables_file=args.fingering_tables, drop_priority=args.drop_priority,
+                                  sweep=args.sweep)
+        sys.exit(1 if failed_files else 0)
+    if args.serve is not None:
+        if args.fingering_tables is not None and os.path.isfile(args.fingering_tables):
+            load_fingering_tables(args.fingering_tables)
+        tab_converter = Converter(args.tuning_offset, args.capo_fret, args.global_fingering, args.raw_reader,
+                                  args.voicing_cache, drop_priority=args.drop_priority)
+        try:
+            asyncio.run(serve_tabs(tab_converter, args.serve))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        sys.exit(0)
+    run_profiler = Profiler() if args.profile else None
+    try:
+        with profiling(run_profiler):
+            main(args.midi_file, args.channel_number, args.tuning_offset, args.capo_fret, args.voicing_cache,
+                 args.global_fingering, args.raw_reader, workers=args.workers, sweep=args.sweep,
+                 fingering_tables_file=args.fingering_tables, drop_priority=args.drop_priority,
+                 dropped_output=sys.stderr if args.report_dropped else None, incremental_file=args.incremental)
+    except InvalidChannelError as e:
+        print("Invalid channel selected. Here is a list of valid channels:")
+        for channel in e.valid_channels:
+            print(channel)
+        sys.exit(1)
+    if run_profiler is not None:
+        if args.profile_format == "json":
+            run_profiler.write_json_lines(sys.stderr)
+        else:
+            run_profiler.write_text(sys.stderr)
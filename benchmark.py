@@ -0,0 +1,486 @@
+import gc
+import os
+import sys
+import glob
+import json
+import io
+import time
+import random
+import statistics
+import subprocess
+import argparse
+import contextlib
+import tempfile
+import tracemalloc
+from dataclasses import dataclass
+from mido import MidiFile, MidiTrack, Message, MetaMessage
+import MidiToTabs
+
+
+# Pick the solution with the lowest avg string value, kept from the python-constraint solver
+def legacy_pick_min_string_index(solutions):
+    min_solution = solutions[0]
+
+    min_avg_string_index = 6
+    for solution in solutions:
+        sum_string_index = 0
+        for dict_val in solution.values():
+            sum_string_index += dict_val.string_index
+        avg_string_index = sum_string_index / len(solution)
+        if avg_string_index < min_avg_string_index:
+            min_solution = solution
+            min_avg_string_index = avg_string_index
+
+    return min_solution
+
+
+# Checks for bars that are unplayable and removes them from the solution set, kept from the python-constraint solver
+def legacy_remove_unplayable_bars(solutions):
+    return [solution for solution in solutions
+            if MidiToTabs.is_playable_bar([guitar_note.fret for guitar_note in solution.values()])]
+
+
+# The python-constraint chord solver that find_best_voicing replaced, kept as the baseline to benchmark against
+def legacy_optimize_simultaneous_notes(simultaneous_notes, guitar_index):
+    from constraint import Problem
+
+    problem = Problem()
+
+    variables = []
+    for cur_note in simultaneous_notes:
+        if str(cur_note.note) not in variables:
+            variables.append(str(cur_note.note))
+            potential_guitar_notes = [MidiToTabs.GuitarNote(guitar_index.string_names[string_index], string_index, fret,
+                                                            quarter_beat_index=cur_note.quarter_beat_index)
+                                      for string_index, fret in guitar_index[cur_note.note]]
+            problem.addVariable(str(cur_note.note), potential_guitar_notes)
+
+    for i in range(len(variables)):
+        for j in range(i + 1, len(variables)):
+            problem.addConstraint(MidiToTabs.frets_compatible, (variables[i], variables[j]))
+            problem.addConstraint(lambda a, b: a.string_index != b.string_index, (variables[i], variables[j]))
+
+    solutions = problem.getSolutions()
+    if len(solutions) == 0:
+        simultaneous_notes.pop(1)
+        return legacy_optimize_simultaneous_notes(simultaneous_notes, guitar_index)
+
+    best_solution = legacy_pick_min_string_index(solutions)
+
+    solutions = legacy_remove_unplayable_bars(solutions)
+
+    if solutions:
+        best_solution = legacy_pick_min_string_index(solutions)
+
+    return best_solution
+
+
+# Groups notes that share a quarter beat, keeping only the groups that need the chord solver
+def collect_chords(notes_on):
+    chords = {}
+    for note in notes_on:
+        chords.setdefault(note.quarter_beat_index, []).append(note)
+    return [chord for chord in chords.values() if len(chord) > 1]
+
+
+# Collects every chord of every channel of the given songs
+def load_chords(midi_files, tuning_offset, capo_offset):
+    guitar_index, guitar_range = MidiToTabs.create_guitar_index(tuning_offset, capo_offset)
+    chords = []
+    for midi_file in midi_files:
+        song_scan = MidiToTabs.read_song(midi_file)
+        for _, _, channel in MidiToTabs.get_channel_info(song_scan):
+            notes_on = MidiToTabs.create_notes(song_scan.channel_notes[channel], song_scan.time_info_dict,
+                                               guitar_range, channel)
+            chords.extend(collect_chords(notes_on))
+    return chords, guitar_index
+
+
+# Times solving every chord with the given solver, best of the given number of repeats
+def time_solver(solver, chords, guitar_index, repeats):
+    best_time = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for chord in chords:
+            solver(list(chord), guitar_index)
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return best_time
+
+
+# Compares the fingering search engine against the python-constraint solver on the given songs
+def benchmark_chord_solver(midi_files, tuning_offset=0, capo_offset=0, repeats=3):
+    chords, guitar_index = load_chords(midi_files, tuning_offset, capo_offset)
+    legacy_time = time_solver(legacy_optimize_simultaneous_notes, chords, guitar_index, repeats)
+    engine_time = time_solver(MidiToTabs.optimize_simultaneous_notes, chords, guitar_index, repeats)
+
+    same_voicings = 0
+    for chord in chords:
+        legacy = legacy_optimize_simultaneous_notes(list(chord), guitar_index)
+        engine = MidiToTabs.optimize_simultaneous_notes(list(chord), guitar_index)
+        if {(g.string_index, g.fret) for g in legacy.values()} == {(g.string_index, g.fret) for g in engine.values()}:
+            same_voicings += 1
+
+    print(f"Chord solver on {len(midi_files)} songs, {len(chords)} chords:")
+    print(f"  python-constraint: {legacy_time * 1000:9.2f} ms")
+    print(f"  fingering search:  {engine_time * 1000:9.2f} ms ({legacy_time / engine_time:.1f}x faster)")
+    print(f"  identical voicings: {same_voicings}/{len(chords)}")
+
+
+# Writes a random multi-track song of roughly the given size in bytes, using running status like most sequencers
+def write_synthetic_song(path, target_bytes, num_tracks=8, seed=0):
+    rng = random.Random(seed)
+    song = MidiFile(ticks_per_beat=480)
+    conductor = MidiTrack([MetaMessage("time_signature", numerator=4, denominator=4),
+                           MetaMessage("set_tempo", tempo=500000)])
+    for tempo_index in range(1, 64):
+        conductor.append(MetaMessage("set_tempo", tempo=rng.randint(300000, 900000), time=7680))
+    song.tracks.append(conductor)
+
+    # Each note_on/note_off pair takes about 6 bytes with running status
+    notes_per_track = max(1, target_bytes // (6 * num_tracks))
+    for track_index in range(num_tracks):
+        channel = track_index if track_index < 9 else track_index + 1
+        track = MidiTrack([Message("program_change", channel=channel, program=rng.randint(0, 127))])
+        for _ in range(notes_per_track):
+            note = rng.randint(40, 84)
+            track.append(Message("note_on", channel=channel, note=note, velocity=rng.randint(1, 127),
+                                 time=rng.choice((0, 0, 120, 240))))
+            track.append(Message("note_on", channel=channel, note=note, velocity=0, time=rng.choice((60, 120))))
+        song.tracks.append(track)
+    song.save(path)
+
+
+# Times one way of reading a song, best of the given number of repeats
+def time_reader(midi_file, raw_reader, repeats):
+    best_time = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        MidiToTabs.read_song(midi_file, raw_reader)
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return best_time
+
+
+# Checks that both readers scan the same song
+def readers_match(midi_file):
+    mido_scan = MidiToTabs.read_song(midi_file)
+    raw_scan = MidiToTabs.read_song(midi_file, raw_reader=True)
+    return mido_scan.time_info_dict == raw_scan.time_info_dict and \
+        mido_scan.channel_programs == raw_scan.channel_programs and \
+        mido_scan.channel_message_counts == raw_scan.channel_message_counts and \
+        {channel: list(events) for channel, events in mido_scan.channel_notes.items()} == \
+        {channel: list(events) for channel, events in raw_scan.channel_notes.items()}
+
+
+# Compares the raw byte reader against mido on the given songs and on synthetic songs of the given sizes in megabytes
+def benchmark_reader(midi_files, synthetic_sizes_mb=(1, 4), repeats=3):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        midi_files = list(midi_files)
+        for size_mb in synthetic_sizes_mb:
+            path = os.path.join(temp_dir, f"synthetic_{size_mb}mb.mid")
+            write_synthetic_song(path, int(size_mb * 1000000))
+            midi_files.append(path)
+
+        print("MIDI reader:")
+        for midi_file in midi_files:
+            mido_time = time_reader(midi_file, False, repeats)
+            raw_time = time_reader(midi_file, True, repeats)
+            print(f"  {os.path.basename(midi_file):60.60s} {os.path.getsize(midi_file) / 1000000:6.2f} MB  "
+                  f"mido {mido_time * 1000:9.2f} ms  raw {raw_time * 1000:9.2f} ms  "
+                  f"({mido_time / raw_time:.1f}x faster)  {'match' if readers_match(midi_file) else 'MISMATCH'}")
+
+
+# The plain dataclass notes that the slotted classes and note tables replaced, kept as the baseline for memory use
+@dataclass
+class LegacyNote:
+    name: str
+    note: int
+    on: bool
+    velocity: int
+    channel: int
+    time: int
+    quarter_beat_index: int
+
+
+@dataclass
+class LegacyGuitarNote:
+    string_name: str
+    string_index: int
+    fret: int
+    start_time: int = 0
+    quarter_beat_index: int = 0
+
+
+# Returns the bytes still held by what build returns, and the peak bytes allocated while building it
+def measure_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+# Tabs the longest channel of a song, keeping nothing but the rendered length, to measure the peak of the pipeline
+def tab_longest_channel(song_scan, guitar_index, guitar_range):
+    channel = MidiToTabs.get_channel_info(song_scan)[0][2]
+    notes_on = MidiToTabs.create_notes(song_scan.channel_notes[channel], song_scan.time_info_dict, guitar_range,
+                                       channel)
+    tab = MidiToTabs.translate_notes(notes_on, guitar_index)
+    with open(os.devnull, "w") as output:
+        MidiToTabs.write_tab(output, tab.guitar_note_list, song_scan.time_info_dict["time_sig_numerator"],
+                             song_scan.time_info_dict["time_sig_denominator"], guitar_index.tuning_offset)
+    return len(tab.guitar_note_list)
+
+
+# Measures the memory the notes and guitar notes of the longest channel of each song take as plain dataclasses,
+# as slotted objects and as note tables, and the peak of tabbing it, on the given songs and a synthetic 100k note song
+def benchmark_memory(midi_files, synthetic_notes=100000, tuning_offset=0, capo_offset=0):
+    guitar_index, guitar_range = MidiToTabs.create_guitar_index(tuning_offset, capo_offset)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        midi_files = list(midi_files)
+        if synthetic_notes:
+            path = os.path.join(temp_dir, f"synthetic_{synthetic_notes // 1000}k_notes.mid")
+            write_synthetic_song(path, 6 * synthetic_notes, num_tracks=1)
+            midi_files.append(path)
+
+        print("Memory of the longest channel, KB held (tracemalloc):")
+        print(f"  {'song':40s} {'notes':>7s} {'dataclass':>10s} {'slots':>8s} {'table':>8s} "
+              f"{'guitar dataclass':>16s} {'guitar slots':>12s} {'guitar table':>12s} {'tab peak':>9s}")
+        for midi_file in midi_files:
+            song_scan = MidiToTabs.read_song(midi_file)
+            channel = MidiToTabs.get_channel_info(song_scan)[0][2]
+            note_events = song_scan.channel_notes[channel]
+            notes_on = MidiToTabs.create_notes(note_events, song_scan.time_info_dict, guitar_range, channel)
+            guitar_notes = MidiToTabs.translate_notes(notes_on, guitar_index).guitar_note_list
+
+            legacy_notes, _ = measure_memory(lambda: [
+                LegacyNote(note.name, note.note, note.on, note.velocity, note.channel, note.time,
+                           note.quarter_beat_index) for note in notes_on])
+            slotted_notes, _ = measure_memory(lambda: list(notes_on))
+            note_table, _ = measure_memory(lambda: MidiToTabs.create_notes(note_events, song_scan.time_info_dict,
+                                                                            guitar_range, channel))
+            legacy_guitar_notes, _ = measure_memory(lambda: [
+                LegacyGuitarNote(guitar_note.string_name, guitar_note.string_index, guitar_note.fret,
+                                 guitar_note.start_time, guitar_note.quarter_beat_index)
+                for guitar_note in guitar_notes])
+            slotted_guitar_notes, _ = measure_memory(lambda: list(guitar_notes))
+            guitar_note_table, _ = measure_memory(
+                lambda: MidiToTabs.GuitarNoteTable(guitar_index.string_names, guitar_notes))
+            _, tab_peak = measure_memory(lambda: tab_longest_channel(song_scan, guitar_index, guitar_range))
+
+            print(f"  {os.path.basename(midi_file)[:40]:40s} {len(notes_on):7d} {legacy_notes / 1000:10.1f} "
+                  f"{slotted_notes / 1000:8.1f} {note_table / 1000:8.1f} {legacy_guitar_notes / 1000:16.1f} "
+                  f"{slotted_guitar_notes / 1000:12.1f} {guitar_note_table / 1000:12.1f} {tab_peak / 1000:9.1f}")
+
+
+# Median wall time in seconds of running a python command line in a fresh process
+def time_cold_start(args, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# Times starting a fresh process for quick commands, which no longer load numpy, mido or asyncio, against
+# the same commands with those imported up front like every run used to, and against tabbing a song
+def benchmark_startup(midi_file, repeats=10):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MidiToTabs.py")
+    eager_imports = "import numpy, mido, asyncio, runpy, sys; "
+    run_script = f"runpy.run_path({script!r}, run_name='__main__')"
+    commands = [
+        ("python startup", ["-c", "pass"]),
+        ("--help", [script, "--help"]),
+        ("--help, eager imports", ["-c", eager_imports + f"sys.argv = [{script!r}, '--help']; " + run_script]),
+        ("--list-channels", [script, midi_file, "--list-channels"]),
+        ("get_channel_info with mido", ["-c", f"import sys; sys.path.insert(0, {os.path.dirname(script)!r}); "
+                                              f"import MidiToTabs; MidiToTabs.get_channel_info({midi_file!r})"]),
+        ("tab longest channel", [script, midi_file]),
+    ]
+
+    print(f"Cold start on {os.path.basename(midi_file)}, median of {repeats} runs:")
+    for name, args in commands:
+        print(f"  {name:30s} {time_cold_start(args, repeats) * 1000:9.1f} ms")
+
+
+# Tunings, capos and fingering modes the suite checks against golden tabs, as (tuning_offset, capo_offset, global)
+GOLDEN_CONFIGURATIONS = ((0, 0, False), (-2, 2, False), (0, 0, True))
+# Synthetic songs only check the default tuning, they are large
+SYNTHETIC_GOLDEN_CONFIGURATIONS = ((0, 0, False), (0, 0, True))
+
+
+# Writes a long single-channel melody of eighth notes lasting the given number of minutes at 120 bpm
+def write_long_song(path, minutes=10, seed=1):
+    rng = random.Random(seed)
+    song = MidiFile(ticks_per_beat=480)
+    track = MidiTrack([MetaMessage("time_signature", numerator=4, denominator=4),
+                       MetaMessage("set_tempo", tempo=500000),
+                       Message("program_change", channel=0, program=25)])
+    note = 60
+    for _ in range(minutes * 60 * 4):
+        note = min(84, max(40, note + rng.randint(-4, 4)))
+        track.append(Message("note_on", channel=0, note=note, velocity=100, time=0))
+        track.append(Message("note_on", channel=0, note=note, velocity=0, time=240))
+    song.tracks.append(track)
+    song.save(path)
+
+
+# Writes chords of six random notes in the guitar's range on every quarter beat, most of which aren't playable
+def write_dense_chord_song(path, measures=32, seed=2):
+    rng = random.Random(seed)
+    song = MidiFile(ticks_per_beat=480)
+    track = MidiTrack([MetaMessage("time_signature", numerator=4, denominator=4),
+                       MetaMessage("set_tempo", tempo=500000),
+                       Message("program_change", channel=0, program=25)])
+    for _ in range(measures * 16):
+        chord = rng.sample(range(40, 85), 6)
+        for note in chord:
+            track.append(Message("note_on", channel=0, note=note, velocity=100, time=0))
+        for index, note in enumerate(chord):
+            track.append(Message("note_on", channel=0, note=note, velocity=0, time=120 if index == 0 else 0))
+    song.tracks.append(track)
+    song.save(path)
+
+
+# Writes a melody whose tempo changes on every note, from a separate conductor track
+def write_tempo_change_song(path, notes=2000, seed=3):
+    rng = random.Random(seed)
+    song = MidiFile(ticks_per_beat=480)
+    conductor = MidiTrack([MetaMessage("time_signature", numerator=3, denominator=4)])
+    for index in range(notes):
+        conductor.append(MetaMessage("set_tempo", tempo=rng.randint(300000, 900000), time=0 if index == 0 else 240))
+    song.tracks.append(conductor)
+    track = MidiTrack([Message("program_change", channel=0, program=25)])
+    for _ in range(notes):
+        note = rng.randint(40, 84)
+        track.append(Message("note_on", channel=0, note=note, velocity=100, time=0))
+        track.append(Message("note_on", channel=0, note=note, velocity=0, time=240))
+    song.tracks.append(track)
+    song.save(path)
+
+
+# Writes the synthetic songs the suite runs, returning their paths
+def write_suite_songs(directory):
+    songs = {
+        "synthetic_long.mid": write_long_song,
+        "synthetic_dense_chords.mid": write_dense_chord_song,
+        "synthetic_tempo_changes.mid": write_tempo_change_song,
+        # Fifteen channels of random notes, every channel but drums
+        "synthetic_many_channels.mid": lambda path: write_synthetic_song(path, 90000, num_tracks=15, seed=4),
+    }
+    paths = []
+    for name, write_song in songs.items():
+        path = os.path.join(directory, name)
+        write_song(path)
+        paths.append(path)
+    return paths
+
+
+# Times each stage of tabbing every channel of a song, best of the given number of repeats, and the peak
+# memory of each stage from one more traced run. Returns {stage: (seconds, peak bytes)}
+def time_song_stages(midi_file, repeats):
+    best_seconds = {}
+    for _ in range(repeats):
+        profiler = MidiToTabs.Profiler(trace_memory=False)
+        MidiToTabs.Converter(profiler=profiler).convert_all_channels(midi_file)
+        seconds = {}
+        for stage, stage_seconds, _ in profiler.stages:
+            seconds[stage] = seconds.get(stage, 0) + stage_seconds
+        for stage, stage_seconds in seconds.items():
+            best_seconds[stage] = min(best_seconds.get(stage, stage_seconds), stage_seconds)
+
+    profiler = MidiToTabs.Profiler()
+    MidiToTabs.Converter(profiler=profiler).convert_all_channels(midi_file)
+    peaks = {}
+    for stage, _, peak in profiler.stages:
+        peaks[stage] = max(peaks.get(stage, 0), peak)
+    return {stage: (best_seconds[stage], peaks[stage]) for stage in best_seconds}
+
+
+# Tabs one channel through main, the streaming path the command line takes, returning the tab text
+def main_tab(midi_file, channel, tuning_offset, capo_offset, global_fingering):
+    output = io.StringIO()
+    MidiToTabs.main(midi_file, channel, tuning_offset, capo_offset, global_fingering=global_fingering,
+                    output=output)
+    return output.getvalue()
+
+
+# Compares the tabs of every channel of a song with its golden files, or writes them when updating. Each tab is
+# made by the Converter with mido, by the Converter with the raw reader and by main, and all three must match.
+# Returns (golden file name, path, match, missing or mismatch) tuples
+def check_goldens(midi_file, goldens_dir, configurations, update):
+    song_name = os.path.splitext(os.path.basename(midi_file))[0]
+    checks = []
+    for tuning_offset, capo_offset, global_fingering in configurations:
+        converter = MidiToTabs.Converter(tuning_offset, capo_offset, global_fingering)
+        raw_results = MidiToTabs.Converter(tuning_offset, capo_offset, global_fingering,
+                                           raw_reader=True).convert_all_channels(midi_file)
+        for result, raw_result in zip(converter.convert_all_channels(midi_file), raw_results):
+            golden_name = f"{song_name}_{result.channel}_{tuning_offset}_{capo_offset}" \
+                          f"{'_global' if global_fingering else ''}.txt"
+            golden_file = os.path.join(goldens_dir, golden_name)
+            if update:
+                with open(golden_file, "w") as f:
+                    f.write(result.text)
+                checks.append((golden_name, "converter", "updated"))
+            elif not os.path.isfile(golden_file):
+                checks.append((golden_name, "converter", "missing"))
+            else:
+                with open(golden_file) as f:
+                    golden = f.read()
+                for path, text in (("converter", result.text), ("raw reader", raw_result.text),
+                                   ("main", main_tab(midi_file, result.channel, tuning_offset, capo_offset,
+                                                     global_fingering))):
+                    checks.append((golden_name, path, "match" if text == golden else "mismatch"))
+    return checks
+
+
+# Times every stage on the given songs and synthetic stress songs, checks their tabs against the golden files
+# and writes one JSON object per line. Returns the number of golden files that didn't match
+def benchmark_suite(midi_files, output, goldens_dir="Goldens", update_goldens=False, repeats=3):
+    if update_goldens:
+        os.makedirs(goldens_dir, exist_ok=True)
+    failures = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        songs = [(midi_file, GOLDEN_CONFIGURATIONS) for midi_file in midi_files] + \
+            [(midi_file, SYNTHETIC_GOLDEN_CONFIGURATIONS) for midi_file in write_suite_songs(temp_dir)]
+        for midi_file, configurations in songs:
+            song = os.path.basename(midi_file)
+            for stage, (seconds, peak) in time_song_stages(midi_file, repeats).items():
+                output.write(json.dumps({"song": song, "stage": stage, "seconds": seconds, "peak_bytes": peak}) +
+                             "\n")
+            for golden_name, path, status in check_goldens(midi_file, goldens_dir, configurations, update_goldens):
+                failures += status in ("missing", "mismatch")
+                output.write(json.dumps({"song": song, "golden": golden_name, "path": path, "status": status}) +
+                             "\n")
+            output.flush()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python3 benchmark.py")
+    parser.add_argument("benchmark", choices=["solver", "reader", "memory", "startup", "suite", "all"], nargs="?",
+                        default="all", help="all runs every benchmark except suite")
+    parser.add_argument("songs", nargs="*", help="midi files to benchmark, Songs/*.mid by default")
+    parser.add_argument("--goldens-dir", default="Goldens", help="where suite keeps its golden tabs")
+    parser.add_argument("--update-goldens", action="store_true", help="make suite rewrite the golden tabs")
+    parser.add_argument("--output", help="file suite writes its JSON lines to, stdout by default")
+    args = parser.parse_args()
+    songs = args.songs if args.songs else sorted(glob.glob("Songs/*.mid"))
+
+    if args.benchmark in ("solver", "all"):
+        benchmark_chord_solver(songs)
+    if args.benchmark in ("reader", "all"):
+        benchmark_reader(songs)
+    if args.benchmark in ("memory", "all"):
+        benchmark_memory(songs)
+    if args.benchmark in ("startup", "all"):
+        benchmark_startup(songs[0])
+    if args.benchmark == "suite":
+        with open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout) as suite_output:
+            failed_goldens = benchmark_suite(songs, suite_output, args.goldens_dir, args.update_goldens)
+        sys.exit(1 if failed_goldens else 0)